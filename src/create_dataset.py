@@ -13,7 +13,8 @@ from utils.utils import set_seed
 from utils.dataset_utils import load_ibl_dataset
 from utils.config_utils import config_from_kwargs, update_config
 
-from loader.make_loader import make_loader
+from loader.base import BaseDataset, get_session_regions
+from loader.shards import ShardWriter
 
 logging.basicConfig(level=logging.INFO) 
 
@@ -108,122 +109,42 @@ train_dataset, val_dataset, test_dataset, meta_data = load_ibl_dataset(
 max_space_length = max(list(meta_data["eid_list"].values()))
 logging.info(f"MAX space length to pad spike data to: {max_space_length}")
 
-train_dataloader = make_loader(
-    train_dataset, 
-    target=[mod for mod in modality if mod in dynamic_acronyms],
-    load_meta=config.data.load_meta,
-    batch_size=1, 
-    pad_to_right=True, 
-    pad_value=-1.,
-    max_time_length=config.data.max_time_length,
-    max_space_length=max_space_length,
-    dataset_name=config.data.dataset_name,
-    sort_by_depth=config.data.sort_by_depth,
-    sort_by_region=config.data.sort_by_region,
-    stitching=True,
-    seed=config.seed,
-    shuffle=True
-)
-
 base_path = args.data_path
 dataset_name = 'ibl_mm' if args.num_sessions == 1 else f'ibl_mm_{args.num_sessions}'
 
-train_save_dir = os.path.join(base_path, dataset_name, 'train')
-val_save_dir = os.path.join(base_path, dataset_name, 'val')
-test_save_dir = os.path.join(base_path, dataset_name, 'test')
-os.makedirs(train_save_dir, exist_ok=True)
-os.makedirs(val_save_dir, exist_ok=True)
-os.makedirs(test_save_dir, exist_ok=True)
-
-count = 0
-for train_data in tqdm(train_dataloader):
-    new_dict = {}
-    for key, value in train_data.items():
-        if type(value) == torch.Tensor:
-            value = value.cpu().numpy()
-        if key == 'neuron_regions':
-            neuron_region=[]
-            for i in range(len(value)):
-                neuron_region.append(value[i][0])
-            new_dict[key] = neuron_region
-        else:
-            new_dict[key] = value[0]
-    eid = new_dict['eid']
-    save_path = os.path.join(train_save_dir, f"{eid}_{count}")
-    # save to npy file
-    np.save(save_path, new_dict)
-    count += 1
-
-count = 0
-val_dataloader = make_loader(
-    val_dataset, 
-    target=[mod for mod in modality if mod in dynamic_acronyms],
-    load_meta=config.data.load_meta,
-    batch_size=1, 
-    pad_to_right=True, 
-    pad_value=-1.,
-    max_time_length=config.data.max_time_length,
-    max_space_length=max_space_length,
-    dataset_name=config.data.dataset_name,
-    sort_by_depth=config.data.sort_by_depth,
-    sort_by_region=config.data.sort_by_region,
-    stitching=True,
-    seed=config.seed,
-    shuffle=False
-)
-for val_data in tqdm(val_dataloader):
-    new_dict = {}
-    for key, value in val_data.items():
-        if type(value) == torch.Tensor:
-            # change to numpy array
-            value = value.cpu().numpy()
-        if key == 'neuron_regions':
-            neuron_region=[]
-            for i in range(len(value)):
-                neuron_region.append(value[i][0])
-            new_dict[key] = neuron_region
-        else:
-            new_dict[key] = value[0]
-    eid = new_dict['eid']
-    save_path = os.path.join(val_save_dir, f"{eid}_{count}")
-    # save to npy file
-    np.save(save_path, new_dict)
-    count += 1
-
-count = 0
-test_dataloader = make_loader(
-    test_dataset, 
-    target=[mod for mod in modality if mod in dynamic_acronyms],
-    load_meta=config.data.load_meta,
-    batch_size=1, 
-    pad_to_right=True, 
-    pad_value=-1.,
-    max_time_length=config.data.max_time_length,
-    max_space_length=max_space_length,
-    dataset_name=config.data.dataset_name,
-    sort_by_depth=config.data.sort_by_depth,
-    sort_by_region=config.data.sort_by_region,
-    stitching=True,
-    seed=config.seed,
-    shuffle=False
-)
-for test_data in tqdm(test_dataloader):
-    new_dict = {}
-    for key, value in test_data.items():
-        if type(value) == torch.Tensor:
-            # change to numpy array
-            value = value.cpu().numpy()
-        if key == 'neuron_regions':
-            neuron_region=[]
-            for i in range(len(value)):
-                neuron_region.append(value[i][0])
-            new_dict[key] = neuron_region
-        else:
-            new_dict[key] = value[0]
-    eid = new_dict['eid']
-    save_path = os.path.join(test_save_dir, f"{eid}_{count}")
-    # save to npy file
-    np.save(save_path, new_dict)
-    count += 1
+# One region vocabulary for all splits, so that region ids agree between them
+regions = np.unique(np.concatenate([
+    get_session_regions(dataset) for dataset in [train_dataset, val_dataset, test_dataset]
+])) if config.data.load_meta else None
+
+def save_split(dataset, mode):
+    # Trials are written in dataset order, which keeps every session contiguous
+    split_dataset = BaseDataset(
+        dataset, 
+        target=[mod for mod in modality if mod in dynamic_acronyms],
+        load_meta=config.data.load_meta,
+        pad_to_right=True, 
+        pad_value=-1.,
+        max_time_length=config.data.max_time_length,
+        max_space_length=max_space_length,
+        dataset_name=config.data.dataset_name,
+        sort_by_depth=config.data.sort_by_depth,
+        sort_by_region=config.data.sort_by_region,
+        stitching=True,
+        compact_dtypes=config.data.compact_dtypes,
+        regions=regions,
+    )
+    writer = ShardWriter(
+        os.path.join(base_path, dataset_name, mode), max_time_length=config.data.max_time_length,
+        regions=split_dataset.regions,
+    )
+    for idx in tqdm(range(len(split_dataset)), desc=mode):
+        writer.add(split_dataset[idx])
+    manifest = writer.close()
+    logging.info(f"Saved {mode} split: {len(manifest['sessions'])} sessions")
+
+save_split(train_dataset, "train")
+save_split(val_dataset, "val")
+save_split(test_dataset, "test")
 
 logging.info("Finished saving data")
@@ -122,6 +122,12 @@ def main(tune_config=None):
         sort_by_region=config.data.sort_by_region,
         stitching=True,
         seed=config.seed,
+        batched_fetch=config.data.batched_fetch,
+        dynamic_padding=config.data.dynamic_padding,
+        max_sessions_per_batch=config.data.max_sessions_per_batch,
+        cache_dir=config.data.cache_dir,
+        compact_dtypes=config.data.compact_dtypes,
+        verify_checksums=config.data.verify_checksums,
         data_dir=f"{args.data_path}/ibl_mm",
         mode="train",
         eids=list(meta_data["eids"]),
@@ -142,6 +148,12 @@ def main(tune_config=None):
         sort_by_region=config.data.sort_by_region,
         stitching=True,
         seed=config.seed,
+        batched_fetch=config.data.batched_fetch,
+        dynamic_padding=config.data.dynamic_padding,
+        max_sessions_per_batch=config.data.max_sessions_per_batch,
+        cache_dir=config.data.cache_dir,
+        compact_dtypes=config.data.compact_dtypes,
+        verify_checksums=config.data.verify_checksums,
         data_dir=f"{args.data_path}/ibl_mm",
         mode="val",
         eids=list(meta_data["eids"]),
@@ -162,6 +174,12 @@ def main(tune_config=None):
         sort_by_region=config.data.sort_by_region,
         stitching=True,
         seed=config.seed,
+        batched_fetch=config.data.batched_fetch,
+        dynamic_padding=config.data.dynamic_padding,
+        max_sessions_per_batch=config.data.max_sessions_per_batch,
+        cache_dir=config.data.cache_dir,
+        compact_dtypes=config.data.compact_dtypes,
+        verify_checksums=config.data.verify_checksums,
         data_dir=f"{args.data_path}/ibl_mm",
         mode="test",
         eids=list(meta_data["eids"]),
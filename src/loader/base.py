@@ -1,11 +1,15 @@
 import os
+import math
 import torch
 import pickle
 import numpy as np
 from utils.dataset_utils import get_binned_spikes_from_sparse
+from utils.session_utils import get_session_idx
+from loader.shards import ShardStore, has_manifest, load_npy_manifest, NEURON_FIELDS
+from loader.cache import TrialCache
 from torch.utils.data.sampler import Sampler
 from typing import List, Optional, Tuple, Dict
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, default_collate
 from numpy.random import default_rng
 
 def _pad_seq_right_to_n(
@@ -121,6 +125,175 @@ def _pad_spike_seq(
 
 
 
+SPARSE_SPIKE_KEYS = ["spikes_sparse_data", "spikes_sparse_indices", "spikes_sparse_indptr"]
+
+def sparse_collate(samples: List[Dict]) -> Dict:
+    r"""
+    Collate function for datasets built with ``sparse_spikes=True``. The per-trial CSR triplets are
+    merged into one COO index tensor ``spikes_coo_indices`` of shape (3, nnz) over (trial, time, neuron)
+    and the matching ``spikes_coo_values``. Everything else goes through the default collate.
+    """
+    batch_idxs, time_idxs, neuron_idxs, values = [], [], [], []
+    for sample_idx, sample in enumerate(samples):
+        indptr = np.asarray(sample["spikes_sparse_indptr"])
+        counts = np.diff(indptr)
+        batch_idxs.append(np.full(indptr[-1], sample_idx, dtype=np.int64))
+        time_idxs.append(np.repeat(np.arange(len(counts), dtype=np.int64), counts))
+        neuron_idxs.append(np.asarray(sample["spikes_sparse_indices"], dtype=np.int64))
+        values.append(np.asarray(sample["spikes_sparse_data"]))
+
+    batch = default_collate([
+        {key: val for key, val in sample.items() if key not in SPARSE_SPIKE_KEYS} for sample in samples
+    ])
+    batch["spikes_coo_indices"] = torch.from_numpy(np.stack([
+        np.concatenate(batch_idxs), np.concatenate(time_idxs), np.concatenate(neuron_idxs)
+    ]))
+    batch["spikes_coo_values"] = torch.from_numpy(np.concatenate(values))
+    return batch
+
+
+def densify_sparse_spikes(batch: Dict, pad_value: float = -1.) -> Dict:
+    r"""
+    Builds the padded ``spikes_data`` tensor from a batch collated by ``sparse_collate``, on the device 
+    the batch lives on. Padded time steps and neurons are set to ``pad_value`` and the spike counts are 
+    written with a single scatter. Batches without COO spikes are returned unchanged.
+    """
+    if "spikes_coo_indices" not in batch:
+        return batch
+    indices, values = batch.pop("spikes_coo_indices"), batch.pop("spikes_coo_values")
+    time_attn_mask, space_attn_mask = batch["time_attn_mask"], batch["space_attn_mask"]
+    valid = time_attn_mask.bool()[:, :, None] & space_attn_mask.bool()[:, None, :]
+    spikes_data = torch.full(
+        valid.shape, pad_value, dtype=torch.float32, device=values.device
+    ).masked_fill_(valid, 0.)
+    spikes_data.index_put_(tuple(indices), values.to(spikes_data.dtype))
+    batch["spikes_data"] = spikes_data
+    return batch
+
+
+def upcast_compact_batch(batch: Dict, pad_value: float = -1.) -> Dict:
+    r"""
+    Restores the model dtypes of a batch loaded with ``compact_dtypes=True``, on the device the batch
+    lives on: uint8 spike counts become float32 with ``pad_value`` written back at the positions masked
+    out by the attention masks, float16 behaviors become float32 and bool masks become int64.
+    """
+    masks = {key: batch[key] for key in ["time_attn_mask", "space_attn_mask"] if key in batch}
+    masks = {key: mask.long() if mask.dtype == torch.bool else mask for key, mask in masks.items()}
+    spikes_data = batch.get("spikes_data")
+    if torch.is_tensor(spikes_data) and spikes_data.dtype == torch.uint8:
+        valid = masks["time_attn_mask"].bool()[:, :, None] & masks["space_attn_mask"].bool()[:, None, :]
+        batch["spikes_data"] = spikes_data.float().masked_fill_(~valid, pad_value)
+    for key, value in batch.items():
+        if torch.is_tensor(value) and value.dtype == torch.float16:
+            batch[key] = value.float()
+    batch.update(masks)
+    return batch
+
+
+def _restore_spike_padding(spikes_data, time_attn_mask, space_attn_mask, pad_value=-1.):
+    # Compact shards store padded spike positions as 0; writes `pad_value` back from the attention
+    # masks, for a trial ([T, N]) or a stacked batch ([B, T, N])
+    valid = time_attn_mask.astype(bool)[..., :, None] & space_attn_mask.astype(bool)[..., None, :]
+    return np.where(valid, spikes_data, pad_value).astype(np.float32, copy=False)
+
+
+def cast_trial_dtypes(data: Dict, dtypes: Dict) -> Dict:
+    # Casts the fields of a trial (or of a stacked batch) to `dtypes`; spikes cast to uint8 keep
+    # zeros at padded positions, which `upcast_compact_batch` refills from the attention masks
+    for key, dtype in dtypes.items():
+        if key not in data:
+            continue
+        value = np.asarray(data[key])
+        if dtype == np.uint8 and value.dtype != np.uint8:
+            if value.size and value.max() > np.iinfo(np.uint8).max:
+                raise ValueError(f"Spike counts up to {value.max()} in {key} do not fit in uint8.")
+            value = np.maximum(value, 0)
+        data[key] = value.astype(dtype, copy=False)
+    return data
+
+
+# Dtypes of the fields that travel compactly with `compact_dtypes=True`, and their model dtypes;
+# the dynamic behaviors in `BaseDataset.target` are added as float fields
+COMPACT_DTYPES = {
+    "spikes_data": np.uint8,
+    "spikes_sparse_data": np.uint8,
+    "spikes_coo_values": np.uint8,
+    "time_attn_mask": np.bool_,
+    "space_attn_mask": np.bool_,
+    "target": np.float16,
+    "choice": np.float16,
+    "block": np.float16,
+    "reward": np.float16,
+}
+FULL_DTYPES = {
+    key: np.int64 if dtype == np.bool_ else np.float32 for key, dtype in COMPACT_DTYPES.items()
+}
+
+
+REGION_PAD_ID = -1
+
+
+def _pad_regions(neuron_regions, length):
+    # Region ids are padded with `REGION_PAD_ID`; string regions (legacy exports) with "" and kept as a list
+    neuron_regions = np.asarray(neuron_regions)
+    pad_width = (0, max(0, length - neuron_regions.shape[-1]))
+    if neuron_regions.dtype.kind == "U":
+        return list(np.pad(neuron_regions, pad_width, constant_values=""))
+    return np.pad(neuron_regions, pad_width, constant_values=REGION_PAD_ID)
+
+
+def _pad_neurons_to_batch_max(samples: List[Dict], pad_value: float = -1.) -> List[Dict]:
+    # Pads the neuron axis of every sample to the widest sample in the batch
+    n_neurons = [len(sample["space_attn_mask"]) for sample in samples]
+    max_space_length = max(n_neurons)
+    pad_values = {"spikes_data": pad_value, "space_attn_mask": 0, "neuron_depths": np.nan}
+    padded = []
+    for sample, n in zip(samples, n_neurons):
+        sample = dict(sample)
+        if n < max_space_length:
+            for key, val in pad_values.items():
+                if key not in sample:
+                    continue
+                seq = np.asarray(sample[key])
+                sample[key] = np.pad(
+                    seq, [(0, 0)] * (seq.ndim - 1) + [(0, max_space_length - n)], constant_values=val
+                )
+            if "neuron_regions" in sample:
+                sample["neuron_regions"] = _pad_regions(sample["neuron_regions"], max_space_length)
+            sample["spikes_spacestamps"] = np.arange(max_space_length).astype(np.int64)
+        padded.append(sample)
+    return padded
+
+
+def collate_trials(batch, sparse_spikes=False, dynamic_padding=False, pad_value=-1.) -> Dict:
+    r"""
+    Collate function used by ``make_loader``. Batches stacked by ``BaseDataset.__getitems__`` (``batched_fetch=True``)
+    are numpy arrays that only need to be converted to tensors. Lists of samples are padded to the widest trial
+    when ``dynamic_padding`` is set and then go through ``sparse_collate`` or the default collate.
+    """
+    if isinstance(batch, dict):
+        return {
+            key: torch.from_numpy(val) if isinstance(val, np.ndarray) and val.dtype.kind in "biuf" else val
+            for key, val in batch.items()
+        }
+    if dynamic_padding:
+        batch = _pad_neurons_to_batch_max(batch, pad_value)
+    return sparse_collate(batch) if sparse_spikes else default_collate(batch)
+
+
+def _lookup_codes(values: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    # vectorized version of the dictionary lookups in `BaseDataset._apply_lookups`
+    codes = np.searchsorted(keys, values).clip(0, len(keys) - 1)
+    missing = keys[codes] != values
+    if np.any(missing):
+        raise KeyError(f"Values {np.unique(values[missing])} not found in lookup {keys}.")
+    return codes
+
+
+CHOICE_VALUES = np.array([-1., 1.], dtype=np.float32)
+BLOCK_VALUES = np.array([0.2, 0.5, 0.8], dtype=np.float32)
+
+
 def get_length_grouped_indices(lengths, batch_size, shuffle=True, mega_batch_mult=None, generator=None):
     # Default for mega_batch_mult: 50 or the number to get 4 megabatches, whichever is smaller.
     if mega_batch_mult is None:
@@ -217,6 +390,22 @@ class LengthGroupedSampler(Sampler):
 
 
 
+def _get_trial_index(dataset):
+    # Metadata-only view of the dataset, None if it can only be read trial by trial
+    if hasattr(dataset, "get_trial_index"):
+        return dataset.get_trial_index()
+    return None
+
+
+def _group_indices_by_eid(eids):
+    # Trial indices per session, with sessions in order of first appearance
+    eids = np.asarray(eids)
+    unique_eids, first, inverse = np.unique(eids, return_index=True, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    groups = np.split(order, np.cumsum(np.bincount(inverse, minlength=len(unique_eids)))[:-1])
+    return {unique_eids[k]: groups[k].tolist() for k in np.argsort(first)}
+
+
 class SessionSampler(Sampler):
     """Custom Sampler that batches data by session ID (eid)."""
     def __init__(self, dataset, generator, shuffle=True, seed=42):
@@ -226,6 +415,9 @@ class SessionSampler(Sampler):
         self.indices_by_eid = self._group_by_eid()
         
     def _group_by_eid(self):
+        trial_index = _get_trial_index(self.data_source)
+        if trial_index is not None:
+            return _group_indices_by_eid(trial_index["eid"])
         from collections import defaultdict
         indices_by_eid = defaultdict(list)
         for idx, data in enumerate(self.data_source):
@@ -248,6 +440,109 @@ class SessionSampler(Sampler):
 
 
 
+class SessionBatchSampler(SessionSampler):
+    r"""
+    Batch sampler built on ``SessionSampler`` that draws every batch from at most ``max_sessions``
+    sessions: each session is cut into chunks of ``batch_size // max_sessions`` trials and batches
+    are formed from ``max_sessions`` consecutive (shuffled) chunks.
+    """
+    def __init__(self, dataset, batch_size, generator, max_sessions=1, shuffle=True, seed=42):
+        super().__init__(dataset, generator, shuffle=shuffle, seed=seed)
+        self.batch_size = batch_size
+        self.max_sessions = max(1, min(max_sessions, batch_size))
+        self.chunk_size = batch_size // self.max_sessions
+
+    def _sessions(self):
+        return list(self.indices_by_eid.keys())
+
+    def _num_batches(self, eids):
+        n_chunks = sum(math.ceil(len(self.indices_by_eid[eid]) / self.chunk_size) for eid in eids)
+        return math.ceil(n_chunks / self.max_sessions)
+
+    def _chunks(self):
+        chunks = []
+        for eid in self._sessions():
+            indices = self.indices_by_eid[eid]
+            if self.shuffle:
+                indices = [indices[ind] for ind in torch.randperm(len(indices), generator=self.generator)]
+            chunks.extend(indices[i:i+self.chunk_size] for i in range(0, len(indices), self.chunk_size))
+        if self.shuffle:
+            chunks = [chunks[ind] for ind in torch.randperm(len(chunks), generator=self.generator)]
+        return chunks
+
+    def __iter__(self):
+        chunks = self._chunks()
+        for i in range(0, len(chunks), self.max_sessions):
+            yield [idx for chunk in chunks[i:i+self.max_sessions] for idx in chunk]
+
+    def __len__(self):
+        return self._num_batches(self._sessions())
+
+
+
+class DistributedSessionBatchSampler(SessionBatchSampler):
+    r"""
+    Rank-aware ``SessionBatchSampler``: sessions are split across ``num_replicas`` ranks, balanced
+    by trial count, and every rank draws session-grouped batches from its own sessions only. With
+    ``shard_affinity`` the assignment is fixed for the whole run, so each rank keeps reading the
+    same shards; otherwise it is redrawn every epoch. Shuffling is seeded by ``seed + epoch``
+    (see ``set_epoch``) and every rank yields the same number of batches.
+    """
+    def __init__(
+        self, dataset, batch_size, num_replicas=None, rank=None, max_sessions=1,
+        shuffle=True, seed=42, shard_affinity=True,
+    ):
+        if num_replicas is None or rank is None:
+            if not torch.distributed.is_available() or not torch.distributed.is_initialized():
+                raise RuntimeError("num_replicas and rank are required outside of torch.distributed.")
+            num_replicas = torch.distributed.get_world_size() if num_replicas is None else num_replicas
+            rank = torch.distributed.get_rank() if rank is None else rank
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank}, rank should be in the interval [0, {num_replicas - 1}].")
+        super().__init__(dataset, batch_size, torch.Generator(), max_sessions=max_sessions, shuffle=shuffle, seed=seed)
+        if len(self.indices_by_eid) < num_replicas:
+            raise ValueError(f"{len(self.indices_by_eid)} sessions can not be split over {num_replicas} ranks.")
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.shard_affinity = shard_affinity
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _sessions_by_rank(self):
+        eids = list(self.indices_by_eid.keys())
+        sizes = np.array([len(self.indices_by_eid[eid]) for eid in eids])
+        if self.shuffle and not self.shard_affinity:
+            order = np.random.default_rng(self.seed + self.epoch).permutation(len(eids))
+        else:
+            # Longest first, which gives the tightest balance and the same split in every epoch
+            order = np.argsort(-sizes, kind="stable")
+        # Greedy assignment of sessions to the least loaded rank
+        load = np.zeros(self.num_replicas, dtype=np.int64)
+        sessions_by_rank = [[] for _ in range(self.num_replicas)]
+        for i in order:
+            r = int(np.argmin(load))
+            sessions_by_rank[r].append(eids[i])
+            load[r] += sizes[i]
+        return sessions_by_rank
+
+    def _sessions(self):
+        return self._sessions_by_rank()[self.rank]
+
+    def __iter__(self):
+        self.generator.manual_seed(self.seed + self.epoch)
+        batches = list(super().__iter__())
+        # Ranks with fewer trials repeat their first batches so that all ranks step together
+        n_batches = len(self)
+        return iter((batches * math.ceil(n_batches / len(batches)))[:n_batches])
+
+    def __len__(self):
+        return max(self._num_batches(eids) for eids in self._sessions_by_rank())
+
+
+
 def calculate_weights(labels):
     unique_classes = np.unique(labels)
     class_counts = np.zeros(len(unique_classes))
@@ -273,9 +568,16 @@ class WeightedSessionSampler(Sampler):
         labels_by_eid = defaultdict(list)
         weights_by_eid = {}
         within_group_indices_by_eid = []
-        for idx, data in enumerate(self.data_source):
-            indices_by_eid[data['eid']].append(int(idx))
-            labels_by_eid[data['eid']].append(data["target"][0][-1]) 
+        trial_index = _get_trial_index(self.data_source)
+        if trial_index is not None:
+            # The block code is the last target column
+            indices_by_eid = _group_indices_by_eid(trial_index["eid"])
+            for k, v in indices_by_eid.items():
+                labels_by_eid[k] = trial_index["block"][v].astype(np.float32).tolist()
+        else:
+            for idx, data in enumerate(self.data_source):
+                indices_by_eid[data['eid']].append(int(idx))
+                labels_by_eid[data['eid']].append(data["target"][0][-1]) 
         for k, v in labels_by_eid.items():
             weights = calculate_weights(v)
             weights_by_eid[k] = weights / weights.sum()
@@ -349,19 +651,24 @@ class LengthStitchGroupedSampler(Sampler):
         return iter(indices)
 
 
+def get_session_regions(dataset):
+    # Sorted regions of a Hugging Face dataset; regions are session-level metadata, so one row per session is enough
+    _, first = np.unique(np.asarray(dataset["eid"]), return_index=True)
+    return np.unique(np.concatenate([
+        np.asarray(regions, dtype=str) for regions in dataset.select(first.tolist())["cluster_regions"]
+    ]))
+
+
 def get_npy_files(data_dir, mode, eids):
     assert type(eids) == list
-    # get all the npy files in the data directory
+    # Resolve the files of every requested session from the split's session index
+    eids = set(eids)
+    manifest = load_npy_manifest(data_dir, mode)
     data_dir = os.path.join(data_dir, mode)
-    data_paths = [os.path.join(data_dir, f) for f in os.listdir(data_dir)]
-    # only remain files with .npy extension
-    data_paths = [f for f in data_paths if f.endswith('.npy')]
-    # Sort the data paths first by eid then by sample index
-    data_paths.sort(key=lambda x: (os.path.basename(x).split('_')[0], int(os.path.basename(x).split('_')[1].split('.')[0])))
-    # filter by eid
-    # the path contains one of the eids
-    data_paths = [f for f in data_paths if any([eid in f for eid in eids])]
-    return data_paths
+    return [
+        os.path.join(data_dir, f) for session in manifest["sessions"] if session["eid"] in eids
+        for f in session["files"]
+    ]
 
 
 class BaseDataset(torch.utils.data.Dataset):
@@ -384,26 +691,90 @@ class BaseDataset(torch.utils.data.Dataset):
         data_dir = None,
         mode = "train",
         eids = None,
+        sparse_spikes = False,
+        batched_fetch = False,
+        dynamic_padding = False,
+        cache_dir = None,
+        compact_dtypes = False,
+        regions = None,
+        verify_checksums = False,
     ) -> None:
 
+        self.store = None
+        self.data_paths = None
         if data_dir is not None:
-            self.data_paths = get_npy_files(data_dir, mode, eids)
+            if has_manifest(data_dir, mode):
+                self.store = ShardStore(data_dir, mode, eids, verify_checksums=verify_checksums)
+            else:
+                self.data_paths = get_npy_files(data_dir, mode, eids)
         else:
-            self.data_paths = None
             self.dataset = dataset
-            self.target = target
-            self.pad_value = pad_value
-            self.sort_by_depth = sort_by_depth
-            self.sort_by_region = sort_by_region
-            self.max_time_length = max_time_length
-            self.max_space_length = max_space_length
-            self.bin_size = bin_size
-            self.pad_to_right = pad_to_right
-            self.mask_ratio = mask_ratio
-            self.brain_region = brain_region
-            self.load_meta = load_meta
-            self.dataset_name = dataset_name
-            self.stitching = stitching
+        self.target = target
+        self.pad_value = pad_value
+        self.sort_by_depth = sort_by_depth
+        self.sort_by_region = sort_by_region
+        self.max_time_length = max_time_length
+        self.max_space_length = max_space_length
+        self.bin_size = bin_size
+        self.pad_to_right = pad_to_right
+        self.mask_ratio = mask_ratio
+        self.brain_region = brain_region
+        self.load_meta = load_meta
+        self.dataset_name = dataset_name
+        self.stitching = stitching
+        # Shards and legacy .npy trials hold dense spikes; converting them to COO on the host would
+        # only add work, so sparse collation is reserved for the CSR rows of the Arrow datasets
+        if sparse_spikes and data_dir is not None:
+            raise ValueError("sparse_spikes needs CSR spikes; trials read from data_dir are stored dense.")
+        self.sparse_spikes = sparse_spikes
+        self.batched_fetch = batched_fetch
+        self.dynamic_padding = dynamic_padding
+        self.compact_dtypes = compact_dtypes
+        dtypes = COMPACT_DTYPES if compact_dtypes else FULL_DTYPES
+        behaviors = [beh_name.split('-')[0] for beh_name in (target or [])]
+        self.dtypes = {**dtypes, **{beh: dtypes["target"] for beh in behaviors}}
+
+        # Sorted region vocabulary; neuron regions travel as ids into it
+        if regions is None and self.store is not None:
+            regions = self.store.regions
+        elif regions is None and self.data_paths is None and "ibl" in dataset_name and load_meta:
+            regions = get_session_regions(self.dataset)
+        self.regions = None if regions is None else np.unique(np.asarray(regions, dtype=str))
+
+        # Decoded trials shared through a node-local cache (see `loader.cache`)
+        self.cache = None
+        if cache_dir is not None:
+            if sparse_spikes or dynamic_padding:
+                raise ValueError("The trial cache stores fixed-shape dense trials; disable sparse_spikes and dynamic_padding.")
+            self.cache = TrialCache.attach_or_build(self, cache_dir)
+
+    def get_trial_index(self):
+        r"""
+        Per-trial ``eid``, ``choice`` and ``block`` codes, ``n_neurons`` and ``n_time``, read without
+        decoding any trial. Returns None when the data can only be read trial by trial.
+        """
+        if self.store is not None:
+            return self.store.trial_index()
+        elif self.data_paths is None and "ibl" in self.dataset_name:
+            columns = self.dataset.select_columns(["eid", "choice", "block", "spikes_sparse_shape"])
+            n_time, n_neurons = np.asarray(columns["spikes_sparse_shape"], dtype=np.int64).reshape(-1, 2).T
+            return {
+                "eid": np.asarray(columns["eid"]),
+                "choice": _lookup_codes(np.asarray(columns["choice"], dtype=np.float32).reshape(-1), CHOICE_VALUES),
+                "block": _lookup_codes(np.asarray(columns["block"], dtype=np.float32).reshape(-1), BLOCK_VALUES),
+                "n_neurons": np.minimum(n_neurons, self.max_space_length),
+                "n_time": np.minimum(n_time, self.max_time_length),
+            }
+        return None
+
+    def _encode_regions(self, neuron_regions):
+        if self.regions is None:
+            return neuron_regions
+        return _lookup_codes(np.asarray(neuron_regions, dtype=str), self.regions).astype(np.int64)
+
+    def _space_length(self, n_neurons):
+        # With dynamic padding every trial keeps its own width and is padded to the batch max in `collate_trials`
+        return n_neurons if self.dynamic_padding else self.max_space_length
 
     def _preprocess_h5_data(self, data, idx):
         spike_data, rates, _, _ = data
@@ -424,6 +795,9 @@ class BaseDataset(torch.utils.data.Dataset):
 
     def _preprocess_ibl_data(self, data):
 
+        if self.sparse_spikes:
+            return self._preprocess_ibl_sparse_data(data)
+
         # Get sparse data and spike indices
         spikes_sparse_data = [data['spikes_sparse_data']]
         spikes_sparse_indices = [data['spikes_sparse_indices']]
@@ -435,65 +809,45 @@ class BaseDataset(torch.utils.data.Dataset):
             spikes_sparse_data, spikes_sparse_indices, spikes_sparse_indptr, spikes_sparse_shape
         )[0]
 
-        # Prepare target behavior
-        if self.target:
-            target_behavior, target_behavior_dict = self._prepare_target_behavior(data)
-        else:
-            target_behavior = np.array([np.nan])
-
-        # Prepare choice, block, and reward data
-        static_vars = ['choice', 'block', 'reward']
-        choice, block, reward = map(self._prepare_column_data, static_vars, [data] * len(static_vars))
-
-        # Prepare lookup dictionaries
-        choice_lookup = {'-1.0': 0, '1.0': 1}
-        block_lookup = {'0.2': 0, '0.5': 1, '0.8': 2}
-
-        # Create lookup arrays for choice and block
-        _choice, _block = self._apply_lookups(choice, block, choice_lookup, block_lookup, target_behavior.shape[0])
-        choice, block = np.float32(_choice[0]), np.float32(_block[0])
-    
-        # Combine target_behavior with choice and block
-        target_behavior = np.concatenate([target_behavior, _choice, _block], axis=1).astype(np.float32)
+        # Prepare target behavior, choice, block and reward
+        target_behavior, target_behavior_dict, choice, block, reward = self._prepare_behaviors(data)
 
         # Adjust neuron IDs
         include_neuron_ids = np.arange(binned_spikes_data.shape[-1]).astype(np.int64)
         binned_spikes_data = binned_spikes_data[:, include_neuron_ids].squeeze()
+        max_space_length = self._space_length(binned_spikes_data.shape[1])
 
         # Process metadata if `load_meta` is set
         neuron_depths, neuron_regions = self._load_neuron_metadata(
             data, include_neuron_ids
-        ) if self.load_meta else (np.array([np.nan]), np.array([np.nan]))
+        ) if self.load_meta else (np.array([np.nan], dtype=np.float32), np.array([REGION_PAD_ID]))
 
-        # Sort data if specified
-        binned_spikes_data, neuron_depths, neuron_regions = self._sort_data_by_depth_or_region(
-            binned_spikes_data, neuron_depths, neuron_regions
-        )
+        # Sort data if specified; without metadata there is nothing to sort by
+        if self.load_meta:
+            binned_spikes_data, neuron_depths, neuron_regions = self._sort_data_by_depth_or_region(
+                binned_spikes_data, neuron_depths, neuron_regions
+            )
             
         # Pad along time and space dimensions
         binned_spikes_data, pad_time_length = self._pad_data(binned_spikes_data, self.max_time_length, axis=0)
-        binned_spikes_data, pad_space_length = self._pad_data(binned_spikes_data, self.max_space_length, axis=1)
+        binned_spikes_data, pad_space_length = self._pad_data(binned_spikes_data, max_space_length, axis=1)
 
         # Prepare the attention masks
         time_attn_mask = _attention_mask(self.max_time_length, pad_time_length).astype(np.int64)
-        space_attn_mask = _attention_mask(self.max_space_length, pad_space_length).astype(np.int64)
+        space_attn_mask = _attention_mask(max_space_length, pad_space_length).astype(np.int64)
 
         # Generate spike timestamps and spacestamps
         spikes_timestamps = np.arange(self.max_time_length).astype(np.int64)
-        spikes_spacestamps = np.arange(self.max_space_length).astype(np.int64)
+        spikes_spacestamps = np.arange(max_space_length).astype(np.int64)
 
         # Pad neuron_depths and neuron_regions to max_space_length
         neuron_depths = np.pad(
             neuron_depths, 
-            (0, max(0, self.max_space_length - neuron_depths.shape[0])),
+            (0, max(0, max_space_length - neuron_depths.shape[0])),
             constant_values=np.nan
         )
 
-        neuron_regions = np.pad(
-            neuron_regions,
-            (0, max(0, self.max_space_length - neuron_regions.shape[0])),
-            constant_values=""
-        )
+        neuron_regions = _pad_regions(neuron_regions, max_space_length)
 
         return {
             "spikes_data": binned_spikes_data.astype(np.float32),
@@ -503,14 +857,126 @@ class BaseDataset(torch.utils.data.Dataset):
             "spikes_spacestamps": spikes_spacestamps,
             "target": target_behavior,
             "neuron_depths": neuron_depths,
-            "neuron_regions": list(neuron_regions),
+            "neuron_regions": neuron_regions,
+            "eid": data['eid'],
+            "choice": choice,
+            "block": block,
+            "reward": reward,
+            **target_behavior_dict,
+        }
+    
+    def _preprocess_ibl_sparse_data(self, data):
+        # Same outputs as `_preprocess_ibl_data`, but spikes stay as CSR triplets that are
+        # collated into COO indices and densified on the device (see `densify_sparse_spikes`)
+        n_time, n_neurons = data['spikes_sparse_shape']
+        max_space_length = self._space_length(n_neurons)
+        spikes_sparse_indices = np.asarray(data['spikes_sparse_indices'], dtype=np.int64)
+
+        target_behavior, target_behavior_dict, choice, block, reward = self._prepare_behaviors(data)
+
+        include_neuron_ids = np.arange(n_neurons).astype(np.int64)
+        neuron_depths, neuron_regions = self._load_neuron_metadata(
+            data, include_neuron_ids
+        ) if self.load_meta else (np.array([np.nan], dtype=np.float32), np.array([REGION_PAD_ID]))
+
+        # Sorting permutes neurons, so remap the column indices instead of the dense columns
+        if self.load_meta and (self.sort_by_depth or self.sort_by_region):
+            sorted_idxs = np.argsort(neuron_depths, kind="stable") if self.sort_by_depth else np.argsort(neuron_regions, kind="stable")
+            neuron_depths, neuron_regions = neuron_depths[sorted_idxs], neuron_regions[sorted_idxs]
+            inverse_idxs = np.empty_like(sorted_idxs)
+            inverse_idxs[sorted_idxs] = np.arange(len(sorted_idxs))
+            spikes_sparse_indices = inverse_idxs[spikes_sparse_indices]
+
+        time_attn_mask = _attention_mask(self.max_time_length, self.max_time_length - n_time).astype(np.int64)
+        space_attn_mask = _attention_mask(max_space_length, max_space_length - n_neurons).astype(np.int64)
+
+        neuron_depths = np.pad(
+            neuron_depths, 
+            (0, max(0, max_space_length - neuron_depths.shape[0])),
+            constant_values=np.nan
+        )
+        neuron_regions = _pad_regions(neuron_regions, max_space_length)
+
+        return {
+            "spikes_sparse_data": np.asarray(data['spikes_sparse_data'], dtype=np.float32),
+            "spikes_sparse_indices": spikes_sparse_indices,
+            "spikes_sparse_indptr": np.asarray(data['spikes_sparse_indptr'], dtype=np.int64),
+            "time_attn_mask": time_attn_mask,
+            "space_attn_mask": space_attn_mask,
+            "spikes_timestamps": np.arange(self.max_time_length).astype(np.int64),
+            "spikes_spacestamps": np.arange(max_space_length).astype(np.int64),
+            "target": target_behavior,
+            "neuron_depths": neuron_depths,
+            "neuron_regions": neuron_regions,
             "eid": data['eid'],
             "choice": choice,
             "block": block,
             "reward": reward,
             **target_behavior_dict,
         }
+
+    def _preprocess_shard_data(self, data):
+        # Shards store each session at its own neuron count; pad back to `max_space_length`
+        # unless the padding is left to `collate_trials`
+        n_neurons = data["n_neurons"]
+        max_space_length = self._space_length(n_neurons)
+        spikes_data = np.full(
+            (self.max_time_length, max_space_length), self.pad_value, dtype=np.float32
+        )
+        spikes_data[:, :n_neurons] = data["spikes_data"]
+
+        space_attn_mask = _attention_mask(
+            max_space_length, max_space_length - n_neurons
+        ).astype(np.int64)
+        if data["spikes_data"].dtype == np.uint8 and not self.compact_dtypes:
+            spikes_data = _restore_spike_padding(
+                spikes_data, data["time_attn_mask"], space_attn_mask, self.pad_value
+            )
+
+        out = {
+            key: value for key, value in data.items() 
+            if key not in ["n_neurons", "spikes_data", "neuron_depths", "neuron_regions"]
+        }
+        if "neuron_depths" in data:
+            out["neuron_depths"] = np.pad(
+                data["neuron_depths"], 
+                (0, max_space_length - n_neurons), 
+                constant_values=np.nan
+            )
+        if "neuron_regions" in data:
+            out["neuron_regions"] = _pad_regions(data["neuron_regions"], max_space_length)
+        out.update({
+            "spikes_data": spikes_data,
+            "space_attn_mask": space_attn_mask,
+            "spikes_timestamps": np.arange(self.max_time_length).astype(np.int64),
+            "spikes_spacestamps": np.arange(max_space_length).astype(np.int64),
+        })
+        return out
+
+    def _prepare_behaviors(self, data):
+        # Prepare target behavior
+        target_behavior_dict = {}
+        if self.target:
+            target_behavior, target_behavior_dict = self._prepare_target_behavior(data)
+        else:
+            target_behavior = np.array([np.nan])
+
+        # Prepare choice, block, and reward data
+        static_vars = ['choice', 'block', 'reward']
+        choice, block, reward = map(self._prepare_column_data, static_vars, [data] * len(static_vars))
+
+        # Prepare lookup dictionaries
+        choice_lookup = {'-1.0': 0, '1.0': 1}
+        block_lookup = {'0.2': 0, '0.5': 1, '0.8': 2}
+
+        # Create lookup arrays for choice and block
+        _choice, _block = self._apply_lookups(choice, block, choice_lookup, block_lookup, target_behavior.shape[0])
+        choice, block = np.float32(_choice[0]), np.float32(_block[0])
     
+        # Combine target_behavior with choice and block
+        target_behavior = np.concatenate([target_behavior, _choice, _block], axis=1).astype(np.float32)
+        return target_behavior, target_behavior_dict, choice, block, reward
+
     def _prepare_target_behavior(self, data):
         target_behavior = []
         target_behavior_dict = {}
@@ -530,14 +996,16 @@ class BaseDataset(torch.utils.data.Dataset):
 
     def _load_neuron_metadata(self, data, include_neuron_ids):
         neuron_depths = np.array(data['cluster_depths'], dtype=np.float32)[include_neuron_ids].squeeze()
-        neuron_regions = np.array(data['cluster_regions'], dtype='str')[include_neuron_ids].squeeze()
+        neuron_regions = self._encode_regions(
+            np.array(data['cluster_regions'], dtype='str')[include_neuron_ids].squeeze()
+        )
         return neuron_depths, neuron_regions
 
     def _sort_data_by_depth_or_region(self, binned_spikes_data, neuron_depths, neuron_regions):
         if self.sort_by_depth:
-            sorted_idxs = np.argsort(neuron_depths)
+            sorted_idxs = np.argsort(neuron_depths, kind="stable")
         elif self.sort_by_region:
-            sorted_idxs = np.argsort(neuron_regions)
+            sorted_idxs = np.argsort(neuron_regions, kind="stable")
         else:
             sorted_idxs = np.arange(len(neuron_depths))
 
@@ -558,7 +1026,9 @@ class BaseDataset(torch.utils.data.Dataset):
         return data, pad_len
     
     def __len__(self):
-        if self.data_paths is not None:
+        if self.store is not None:
+            return len(self.store)
+        elif self.data_paths is not None:
             return len(self.data_paths)
         elif "ibl" in self.dataset_name:
             return len(self.dataset)
@@ -567,11 +1037,181 @@ class BaseDataset(torch.utils.data.Dataset):
             return len(self.dataset)
         
     def __getitem__(self, idx):
-        if self.data_paths is not None:
+        if self.cache is not None:
+            data = self.cache[idx]
+        else:
+            data = self._get_trial(idx)
+            if not isinstance(data, dict):
+                return data
+            data = cast_trial_dtypes(data, self.dtypes)
+        # Registry id of the session, used by the model instead of the eid string; datasets
+        # without sessions (h5) have no eid
+        if "eid" in data:
+            data["session_idx"] = get_session_idx(data["eid"])[0]
+        return data
+
+    def _get_trial(self, idx):
+        if self.store is not None:
+            return self._preprocess_shard_data(self.store[idx])
+        elif self.data_paths is not None:
             data = np.load(self.data_paths[idx], allow_pickle=True).item()
+            if self.dynamic_padding:
+                n_neurons = data["space_attn_mask"].sum()
+                for key in NEURON_FIELDS + ["space_attn_mask", "spikes_spacestamps"]:
+                    # Legacy exports store `neuron_regions` as a list, which is kept as one
+                    value = data[key]
+                    data[key] = value[:n_neurons] if isinstance(value, list) else value[..., :n_neurons]
             return data
         elif "ibl" in self.dataset_name:
             return self._preprocess_ibl_data(self.dataset[idx])
         else:
-            return self._preprocess_h5_data(self.dataset, idx)  
+            return self._preprocess_h5_data(self.dataset, idx)
+
+    def __getitems__(self, indices):
+        # Called by the DataLoader with all indices of a batch; the batched paths
+        # return the stacked batch and must be paired with `collate_trials`
+        batch = None
+        if self.batched_fetch and self.cache is None:
+            if self.store is not None:
+                batch = self._fetch_shard_batch(indices)
+            elif self.data_paths is None and "ibl" in self.dataset_name and self.target:
+                batch = self._fetch_ibl_batch(indices)
+        if batch is None:
+            return [self[idx] for idx in indices]
+        batch = cast_trial_dtypes(batch, self.dtypes)
+        batch["session_idx"] = get_session_idx(batch["eid"])
+        return batch
+
+    def _fetch_shard_batch(self, indices):
+        session_idxs, trial_idxs = self.store.locate_batch(indices)
+        n_neurons = np.array([s["n_neurons"] for s in self.store.sessions])[session_idxs]
+        max_space_length = self._space_length(n_neurons.max())
+        # Spikes are assembled in the output dtype; the pad value does not fit in compact uint8 ones
+        spikes_dtype = self.dtypes["spikes_data"]
+        spikes_pad_value = 0. if self.compact_dtypes else self.pad_value
+        pad_values = {
+            "spikes_data": spikes_pad_value, "neuron_depths": np.nan,
+            "neuron_regions": "" if self.regions is None else REGION_PAD_ID,
+        }
+
+        batch = {}
+        for session_idx in np.unique(session_idxs):
+            batch_idxs = np.flatnonzero(session_idxs == session_idx)
+            for field, array in self.store.arrays[session_idx].items():
+                # One fancy-indexed read per field and session; session-level fields are broadcast
+                if field in self.store.session_fields:
+                    values = np.broadcast_to(array, (len(batch_idxs), *array.shape))
+                else:
+                    values = array[trial_idxs[batch_idxs]]
+                if field not in batch:
+                    shape = (len(session_idxs), *values.shape[1:])
+                    if field in NEURON_FIELDS:
+                        shape = (*shape[:-1], max_space_length)
+                    dtype = spikes_dtype if field == "spikes_data" else values.dtype
+                    batch[field] = np.full(shape, pad_values.get(field, 0), dtype=dtype)
+                elif np.result_type(batch[field], values) != batch[field].dtype:
+                    batch[field] = batch[field].astype(np.result_type(batch[field], values))
+                if field in NEURON_FIELDS:
+                    batch[field][batch_idxs, ..., :values.shape[-1]] = values
+                else:
+                    batch[field][batch_idxs] = values
+
+        spikes_data = batch.pop("spikes_data")
+        compact_store = self.store.arrays[session_idxs[0]]["spikes_data"].dtype == np.uint8
+        if compact_store and not self.compact_dtypes:
+            space_attn_mask = np.arange(max_space_length)[None, :] < n_neurons[:, None]
+            spikes_data = _restore_spike_padding(
+                spikes_data, batch["time_attn_mask"], space_attn_mask, self.pad_value
+            )
+        eids = [self.store.sessions[session_idx]["eid"] for session_idx in session_idxs]
+        return self._finish_batch(batch, spikes_data, n_neurons, eids, max_space_length)
+
+    def _fetch_ibl_batch(self, indices):
+        # Columnar read of the whole batch from the Arrow table
+        rows = self.dataset[[int(idx) for idx in indices]]
+        n_time, n_neurons = np.asarray(rows["spikes_sparse_shape"], dtype=np.int64).T
+        B, T, N = len(indices), self.max_time_length, self._space_length(n_neurons.max())
+
+        # COO coordinates of all trials at once from the CSR triplets
+        counts = np.concatenate([np.diff(indptr) for indptr in rows["spikes_sparse_indptr"]])
+        time_starts = np.repeat(np.cumsum(n_time) - n_time, n_time)
+        trial_idxs = np.repeat(np.repeat(np.arange(B), n_time), counts)
+        time_idxs = np.repeat(np.arange(n_time.sum()) - time_starts, counts)
+        neuron_idxs = np.concatenate(rows["spikes_sparse_indices"]).astype(np.int64)
+        values = np.concatenate(rows["spikes_sparse_data"]).astype(np.float32)
+
+        # Behaviors and vectorized choice / block lookups
+        target_behavior = np.stack(
+            [np.asarray(rows[beh_name], dtype=np.float32) for beh_name in self.target], axis=-1
+        )
+        choice = _lookup_codes(np.asarray(rows["choice"], dtype=np.float32).reshape(B), CHOICE_VALUES)
+        block = _lookup_codes(np.asarray(rows["block"], dtype=np.float32).reshape(B), BLOCK_VALUES)
+        static_behavior = np.broadcast_to(
+            np.stack([choice, block], axis=-1)[:, None, :], (B, target_behavior.shape[1], 2)
+        )
+
+        batch = {
+            "target": np.concatenate([target_behavior, static_behavior], axis=-1).astype(np.float32),
+            "choice": choice[:, None].astype(np.float32),
+            "block": block[:, None].astype(np.float32),
+            "reward": np.asarray(rows["reward"], dtype=np.float32).reshape(B, -1),
+            **{
+                beh_name.split('-')[0]: target_behavior[..., beh_idx]
+                for beh_idx, beh_name in enumerate(self.target)
+            },
+        }
+
+        if self.load_meta:
+            regions = [self._encode_regions(np.asarray(r, dtype="str")) for r in rows["cluster_regions"]]
+            neuron_depths = np.full((B, N), np.nan, dtype=np.float32)
+            neuron_regions = np.full(
+                (B, N), "" if self.regions is None else REGION_PAD_ID, dtype=np.result_type(*regions)
+            )
+            for trial_idx, depths in enumerate(rows["cluster_depths"]):
+                neuron_depths[trial_idx, :len(depths)] = depths
+                neuron_regions[trial_idx, :len(regions[trial_idx])] = regions[trial_idx]
+
+            # Sort neurons within each trial, keeping the padding at the end
+            if self.sort_by_depth or self.sort_by_region:
+                is_pad = np.arange(N)[None, :] >= n_neurons[:, None]
+                keys = neuron_depths if self.sort_by_depth else neuron_regions
+                sorted_idxs = np.lexsort((keys, is_pad), axis=-1)
+                neuron_depths = np.take_along_axis(neuron_depths, sorted_idxs, axis=-1)
+                neuron_regions = np.take_along_axis(neuron_regions, sorted_idxs, axis=-1)
+                inverse_idxs = np.argsort(sorted_idxs, axis=-1)
+                neuron_idxs = inverse_idxs[trial_idxs, neuron_idxs]
+        else:
+            # Same placeholders as `_preprocess_ibl_data` without metadata
+            neuron_depths = np.full((B, N), np.nan, dtype=np.float32)
+            neuron_regions = np.full((B, N), REGION_PAD_ID, dtype=np.int64)
+        batch["neuron_depths"], batch["neuron_regions"] = neuron_depths, neuron_regions
+
+        time_attn_mask = (np.arange(T)[None, :] < n_time[:, None]).astype(np.int64)
+        batch["time_attn_mask"] = time_attn_mask
+        if self.sparse_spikes:
+            spikes_data = (trial_idxs, time_idxs, neuron_idxs, values)
+        else:
+            space_attn_mask = np.arange(N)[None, :] < n_neurons[:, None]
+            spikes_data = np.full((B, T, N), self.pad_value, dtype=np.float32)
+            spikes_data[time_attn_mask.astype(bool)[:, :, None] & space_attn_mask[:, None, :]] = 0.
+            spikes_data[trial_idxs, time_idxs, neuron_idxs] = values
+        return self._finish_batch(batch, spikes_data, n_neurons, rows["eid"], N)
+
+    def _finish_batch(self, batch, spikes_data, n_neurons, eids, max_space_length):
+        B, T, N = len(eids), self.max_time_length, max_space_length
+        if self.sparse_spikes:
+            # `spikes_data` holds the (trial, time, neuron) coordinates and the spike counts
+            batch["spikes_coo_indices"] = np.stack(spikes_data[:-1]).astype(np.int64)
+            batch["spikes_coo_values"] = np.asarray(spikes_data[-1], dtype=np.float32)
+        else:
+            batch["spikes_data"] = spikes_data
+        batch["space_attn_mask"] = (np.arange(N)[None, :] < n_neurons[:, None]).astype(np.int64)
+        batch["spikes_timestamps"] = np.tile(np.arange(T, dtype=np.int64), (B, 1))
+        batch["spikes_spacestamps"] = np.tile(np.arange(N, dtype=np.int64), (B, 1))
+        if "neuron_regions" in batch and batch["neuron_regions"].dtype.kind == "U":
+            # String regions take the layout the default collate gives the per-trial lists:
+            # one tuple of B regions per neuron
+            batch["neuron_regions"] = list(zip(*batch["neuron_regions"].tolist()))
+        batch["eid"] = list(eids)
+        return batch  
  
\ No newline at end of file
@@ -0,0 +1,152 @@
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import numpy as np
+from typing import Dict, List
+
+""" Node-local cache of decoded trials. The padded trial dicts returned by ``BaseDataset`` are
+materialized once into one ``.npy`` file per field under a tmpfs directory (``/dev/shm`` by
+default), and every DataLoader worker and concurrent tune trial on the node attaches to the
+same files read-only through ``np.load(mmap_mode="r")``, so the pages are shared instead of
+copied and the decoding pass runs once per node.
+
+LAYOUT:
+    {cache_dir}/{key}/meta.json
+    {cache_dir}/{key}/{field}.npy     (n_trials, *trial_shape)
+    {cache_dir}/{key}.lock            held while the cache is built
+"""
+
+DEFAULT_CACHE_DIR = "/dev/shm/neds_cache"
+META_FILE = "meta.json"
+
+# Preprocessing options that change the decoded trials, and hence the cache key
+KEY_ATTRS = [
+    "dataset_name", "target", "pad_value", "max_time_length", "max_space_length", "pad_to_right",
+    "sort_by_depth", "sort_by_region", "brain_region", "load_meta", "stitching", "compact_dtypes",
+]
+
+
+def get_cache_key(dataset) -> str:
+    if dataset.store is not None:
+        manifest = os.path.join(dataset.store.root, "manifest.json")
+        source = [manifest, os.path.getmtime(manifest), sorted(s["eid"] for s in dataset.store.sessions)]
+    elif dataset.data_paths is not None:
+        source = [os.path.dirname(dataset.data_paths[0]) if dataset.data_paths else "", len(dataset.data_paths)]
+    else:
+        source = [getattr(dataset.dataset, "_fingerprint", None), len(dataset)]
+    options = {attr: getattr(dataset, attr) for attr in KEY_ATTRS}
+    blob = json.dumps([source, options], sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+
+class TrialCache():
+    r"""
+    Read-only view over a materialized cache. ``__getitem__`` returns the same dict layout as
+    ``BaseDataset.__getitem__``, with every array a view into the shared mapping.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, META_FILE)) as file:
+            meta = json.load(file)
+        self.n_trials = meta["n_trials"]
+        self.fields = meta["fields"]
+        self.str_fields = meta["str_fields"]
+        self.list_fields = meta["list_fields"]
+        self._arrays = None
+
+    def __getstate__(self):
+        # Re-attached in every DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = {
+                field: np.load(os.path.join(self.root, f"{field}.npy"), mmap_mode="r") for field in self.fields
+            }
+        return self._arrays
+
+    def __len__(self):
+        return self.n_trials
+
+    def __getitem__(self, idx) -> Dict:
+        trial = {field: self.arrays[field][idx] for field in self.fields}
+        for field in self.str_fields:
+            trial[field] = str(trial[field])
+        for field in self.list_fields:
+            trial[field] = list(trial[field])
+        return trial
+
+    @classmethod
+    def attach_or_build(cls, dataset, cache_dir: str = DEFAULT_CACHE_DIR):
+        r"""
+        Attach to the cache of ``dataset`` under ``cache_dir``, building it first if no process on
+        the node has done so yet. Concurrent callers wait on a file lock and attach once it is built.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        root = os.path.join(cache_dir, get_cache_key(dataset))
+        with open(f"{root}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(os.path.join(root, META_FILE)):
+                    cls.build(dataset, root)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return cls(root)
+
+    @staticmethod
+    def _widen(array, dtype, path):
+        # Re-creates a string field with a wider fixed width, keeping the rows written so far
+        widened = np.lib.format.open_memmap(f"{path}.tmp", mode="w+", dtype=dtype, shape=array.shape)
+        widened[:] = array
+        widened.flush()
+        del array
+        os.replace(f"{path}.tmp", path)
+        return np.lib.format.open_memmap(path, mode="r+")
+
+    @staticmethod
+    def build(dataset, root: str):
+        # Written into a temporary directory and renamed, so a cache is either complete or absent
+        tmp_root = f"{root}.tmp.{os.getpid()}"
+        shutil.rmtree(tmp_root, ignore_errors=True)
+        os.makedirs(tmp_root)
+        arrays, str_fields, list_fields = {}, [], []
+        for idx in range(len(dataset)):
+            trial = dataset[idx]
+            if not arrays:
+                for key, value in trial.items():
+                    if isinstance(value, str):
+                        str_fields.append(key)
+                    elif isinstance(value, list):
+                        list_fields.append(key)
+                    value = np.asarray(value)
+                    if value.dtype == object:
+                        raise ValueError(f"Field {key} can not be cached with a fixed dtype.")
+                    arrays[key] = np.lib.format.open_memmap(
+                        os.path.join(tmp_root, f"{key}.npy"), mode="w+", dtype=value.dtype,
+                        shape=(len(dataset), *value.shape),
+                    )
+            for key, array in arrays.items():
+                value = np.asarray(trial[key])
+                # Strings are stored with the fixed width of the longest value seen so far
+                if value.dtype.kind == "U" and value.dtype.itemsize > array.dtype.itemsize:
+                    array.flush()
+                    arrays[key] = array = TrialCache._widen(
+                        array, value.dtype, os.path.join(tmp_root, f"{key}.npy")
+                    )
+                array[idx] = value
+        for array in arrays.values():
+            array.flush()
+        with open(os.path.join(tmp_root, META_FILE), "w") as file:
+            json.dump({
+                "n_trials": len(dataset),
+                "fields": list(arrays.keys()),
+                "str_fields": str_fields,
+                "list_fields": list_fields,
+                "str_dtypes": {key: array.dtype.str for key, array in arrays.items() if array.dtype.kind == "U"},
+            }, file, indent=2)
+        os.rename(tmp_root, root)
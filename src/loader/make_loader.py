@@ -1,12 +1,16 @@
 import random
 import numpy as np
 import torch
+from functools import partial
 from loader.base import (
     BaseDataset, 
     LengthStitchGroupedSampler, 
     LengthGroupedSampler, 
     SessionSampler,
-    WeightedSessionSampler
+    SessionBatchSampler,
+    DistributedSessionBatchSampler,
+    WeightedSessionSampler,
+    collate_trials,
 )
 from torch.utils.data.sampler import WeightedRandomSampler
 
@@ -16,13 +20,16 @@ def seed_worker(worker_id):
     random.seed(worker_seed)
 
 def calculate_weights(labels):
-    unique_classes = np.unique(labels)
-    class_counts = np.zeros(len(unique_classes))
-    for i, c in enumerate(unique_classes):
-        class_counts[i] = (np.array(labels) == c).sum()
-    class_weights = 1.0 / class_counts
-    weights = np.array([class_weights[int(l)] for l in labels])
-    return weights
+    # Inverse class frequency of every sample
+    _, inverse, class_counts = np.unique(np.asarray(labels), return_inverse=True, return_counts=True)
+    return 1.0 / class_counts[inverse.reshape(-1)]
+
+def get_sampler_labels(dataset):
+    # Choice codes from the metadata-only trial index; falls back to decoding every trial
+    trial_index = dataset.get_trial_index()
+    if trial_index is not None:
+        return trial_index["choice"]
+    return np.array([np.asarray(x["choice"]).reshape(-1)[0] for x in dataset])
 
 def make_loader(
     dataset, 
@@ -45,6 +52,16 @@ def make_loader(
     data_dir = None,
     mode='train',
     eids=None,
+    sparse_spikes=False,
+    batched_fetch=False,
+    dynamic_padding=False,
+    max_sessions_per_batch=None,
+    num_replicas=1,
+    rank=0,
+    shard_affinity=True,
+    cache_dir=None,
+    compact_dtypes=False,
+    verify_checksums=False,
 ):
     
     dataset = BaseDataset(
@@ -64,6 +81,17 @@ def make_loader(
         data_dir=data_dir,
         mode=mode,
         eids=eids,
+        sparse_spikes=sparse_spikes,
+        batched_fetch=batched_fetch,
+        dynamic_padding=dynamic_padding,
+        cache_dir=cache_dir,
+        compact_dtypes=compact_dtypes,
+        verify_checksums=verify_checksums,
+    )
+    # Compact uint8 spikes are padded with zeros; the pad value is restored on the device
+    collate_fn = partial(
+        collate_trials, sparse_spikes=sparse_spikes, dynamic_padding=dynamic_padding,
+        pad_value=0 if compact_dtypes else pad_value,
     )
     
     generator = torch.Generator()
@@ -72,18 +100,39 @@ def make_loader(
     if weighted_sampler:
         # Weight samples according to choice
         print(f'Using weighted sampler')
-        labels = [x["target"][0][0] for x in dataset]
+        labels = get_sampler_labels(dataset)
         weights = torch.from_numpy(calculate_weights(labels)).double()
         sampler = WeightedRandomSampler(weights, num_samples=len(weights), generator=generator)
         dataloader = torch.utils.data.DataLoader(
             dataset, sampler=sampler, batch_size=batch_size, 
             worker_init_fn=seed_worker, generator=generator, pin_memory=True,
+            collate_fn=collate_fn,
+        )
+    elif max_sessions_per_batch is not None:
+        # Batches drawn from at most `max_sessions_per_batch` sessions each
+        if num_replicas > 1:
+            # Already sharded over ranks, so the loader must not be passed to `accelerator.prepare`
+            print(f'Using distributed session batch sampler on rank {rank}/{num_replicas}')
+            batch_sampler = DistributedSessionBatchSampler(
+                dataset, batch_size, num_replicas=num_replicas, rank=rank,
+                max_sessions=max_sessions_per_batch, shuffle=shuffle, seed=seed, shard_affinity=shard_affinity,
+            )
+        else:
+            print(f'Using session batch sampler')
+            batch_sampler = SessionBatchSampler(
+                dataset, batch_size, generator, max_sessions=max_sessions_per_batch, shuffle=shuffle, seed=seed
+            )
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_sampler=batch_sampler, 
+            worker_init_fn=seed_worker, generator=generator, pin_memory=True,
+            collate_fn=collate_fn,
         )
     else:
         print(f'Using regular sampler')
         dataloader = torch.utils.data.DataLoader(
             dataset, batch_size=batch_size, shuffle=shuffle, 
             worker_init_fn=seed_worker, generator=generator, pin_memory=True,
+            collate_fn=collate_fn,
         )
 
     return dataloader
@@ -0,0 +1,366 @@
+import os
+import json
+import hashlib
+import numpy as np
+from typing import List, Optional, Dict
+
+""" Columnar trial store. Every split directory holds one sub-directory per session with one
+fixed-dtype ``.npy`` file per field, stacked along the trial axis, plus a ``manifest.json``
+that maps each session to its contiguous range of trials. Arrays are memory-mapped on first
+access, so a trial is a view into the page cache instead of an unpickled dict.
+
+LAYOUT:
+    {data_dir}/{mode}/manifest.json
+    {data_dir}/{mode}/trial_index.npz       per-trial session, labels and lengths (see ``INDEX_FIELDS``)
+    {data_dir}/{mode}/{eid}/{field}.npy     (n_trials, *trial_shape)
+    {data_dir}/{mode}/{eid}/{field}.npy     (n_neurons,) for the session-level ``SESSION_FIELDS``
+
+Neuron regions are stored as integer ids into the sorted ``regions`` vocabulary of the manifest.
+Legacy splits with one pickled ``{eid}_{count}.npy`` dict per trial are indexed once into
+``npy_manifest.json`` (see ``load_npy_manifest``) so file sets are resolved per session.
+"""
+
+MANIFEST_FILE = "manifest.json"
+NPY_MANIFEST_FILE = "npy_manifest.json"
+INDEX_FILE = "trial_index.npz"
+SHARD_VERSION = 1
+
+# Fields that are rebuilt from the manifest when a trial is read, so they are not stored;
+# `session_idx` depends on the order of the runtime session registry
+DERIVED_FIELDS = ["eid", "session_idx", "space_attn_mask", "spikes_timestamps", "spikes_spacestamps"]
+# Fields whose last axis runs over neurons and is trimmed to the session's neuron count
+NEURON_FIELDS = ["spikes_data", "neuron_depths", "neuron_regions"]
+# Neuron metadata shared by all trials of a session, stored once per session
+SESSION_FIELDS = ["neuron_depths", "neuron_regions"]
+# Per-trial metadata kept in the trial index, so samplers never have to decode trials
+INDEX_FIELDS = ["session", "choice", "block", "n_neurons", "n_time"]
+
+
+def get_manifest_path(data_dir, mode):
+    return os.path.join(data_dir, mode, MANIFEST_FILE)
+
+
+def has_manifest(data_dir, mode):
+    return os.path.exists(get_manifest_path(data_dir, mode))
+
+
+def load_manifest(data_dir, mode):
+    with open(get_manifest_path(data_dir, mode)) as file:
+        manifest = json.load(file)
+    if manifest["version"] != SHARD_VERSION:
+        raise ValueError(
+            f"Shard version {manifest['version']} in {data_dir}/{mode} is not supported (expected {SHARD_VERSION})."
+        )
+    return manifest
+
+
+def file_checksum(path, chunk_size=1 << 24):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def validate_manifest(root, manifest, sessions=None, checksums=False):
+    r"""
+    Check that the shards of ``sessions`` (default: all sessions of ``manifest``) match what is on
+    disk: every field file exists, holds ``n_trials`` trials and has the recorded size, and with
+    ``checksums`` also the recorded SHA-1. Raises a ValueError listing every mismatch.
+    """
+    errors = []
+    session_fields = manifest.get("session_fields", [])
+    for session in manifest["sessions"] if sessions is None else sessions:
+        recorded = session.get("checksums", {})
+        for field in manifest["fields"] + session_fields:
+            path = os.path.join(root, session["eid"], f"{field}.npy")
+            if not os.path.exists(path):
+                errors.append(f"{path} is missing")
+                continue
+            if field in recorded and os.path.getsize(path) != recorded[field]["bytes"]:
+                errors.append(f"{path} has {os.path.getsize(path)} bytes, expected {recorded[field]['bytes']}")
+                continue
+            length = np.load(path, mmap_mode="r").shape[0]
+            if field in session_fields:
+                unit, expected = "neurons", session["n_neurons"]
+            else:
+                unit, expected = "trials", session["n_trials"]
+            if length != expected:
+                errors.append(f"{path} holds {length} {unit}, expected {expected}")
+            elif checksums and field in recorded and file_checksum(path) != recorded[field]["sha1"]:
+                errors.append(f"{path} does not match its checksum")
+    if errors:
+        raise ValueError(f"Shards in {root} do not match the manifest:\n" + "\n".join(errors))
+
+
+def validate_npy_manifest(root, manifest):
+    r"""
+    Check a cached ``npy_manifest.json`` against the ``.npy`` files of ``root``: every listed file
+    exists, no file is left out, and the trial counts and ranges of the sessions add up. Raises a
+    ValueError listing every mismatch.
+    """
+    errors = []
+    on_disk = {f for f in os.listdir(root) if f.endswith(".npy")}
+    listed, start = set(), 0
+    for session in manifest["sessions"]:
+        listed.update(session["files"])
+        n_trials = len(session["files"])
+        if (session["n_trials"], session["start"], session["stop"]) != (n_trials, start, start + n_trials):
+            errors.append(
+                f"session {session['eid']} records trials [{session['start']}, {session['stop']}) "
+                f"({session['n_trials']}), expected [{start}, {start + n_trials}) ({n_trials})"
+            )
+        start += n_trials
+    if manifest["n_trials"] != start:
+        errors.append(f"{manifest['n_trials']} trials recorded, the sessions hold {start}")
+    errors += [f"{os.path.join(root, f)} is missing" for f in sorted(listed - on_disk)]
+    errors += [f"{os.path.join(root, f)} is not indexed" for f in sorted(on_disk - listed)]
+    if errors:
+        raise ValueError(
+            f"{os.path.join(root, NPY_MANIFEST_FILE)} does not match the split (delete it to re-index):\n"
+            + "\n".join(errors)
+        )
+
+
+def load_npy_manifest(data_dir, mode):
+    r"""
+    Session index of a legacy split of per-trial ``{eid}_{count}.npy`` files, built with a single
+    directory scan on first use and cached in ``npy_manifest.json``. A cached index is checked
+    against the directory on load (see ``validate_npy_manifest``); delete the file to re-index a
+    changed split.
+    """
+    root = os.path.join(data_dir, mode)
+    path = os.path.join(root, NPY_MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path) as file:
+            manifest = json.load(file)
+        if manifest["version"] == SHARD_VERSION:
+            validate_npy_manifest(root, manifest)
+            return manifest
+
+    files = [f for f in os.listdir(root) if f.endswith(".npy")]
+    files_by_eid = {}
+    for f in files:
+        eid, count = os.path.splitext(f)[0].split("_")
+        files_by_eid.setdefault(eid, []).append((int(count), f))
+    sessions, start = [], 0
+    for eid in sorted(files_by_eid):
+        session_files = [f for _, f in sorted(files_by_eid[eid])]
+        sessions.append({
+            "eid": eid, "start": start, "stop": start + len(session_files),
+            "n_trials": len(session_files), "files": session_files,
+        })
+        start += len(session_files)
+    manifest = {"version": SHARD_VERSION, "split": mode, "n_trials": len(files), "sessions": sessions}
+    try:
+        with open(path, "w") as file:
+            json.dump(manifest, file)
+    except OSError:
+        # Read-only data directories are indexed again on every run
+        pass
+    return manifest
+
+
+class ShardWriter():
+    r"""
+    Writes preprocessed trials (the dicts returned by ``BaseDataset``) into the columnar store.
+    Trials of a session must be added contiguously; a session is flushed to disk as soon as
+    the next one starts. ``regions`` is the vocabulary the region ids of the trials refer to.
+    """
+    def __init__(self, save_dir: str, max_time_length: int, regions: Optional[List[str]] = None):
+        self.save_dir = save_dir
+        self.max_time_length = max_time_length
+        self.regions = None if regions is None else [str(region) for region in regions]
+        self.sessions = []
+        self.fields = None
+        self.session_fields = None
+        self.index = {field: [] for field in INDEX_FIELDS}
+        self._eid = None
+        self._buffer = {}
+        self._session_buffer = {}
+        os.makedirs(save_dir, exist_ok=True)
+
+    def add(self, data: Dict):
+        eid = str(data["eid"])
+        if eid != self._eid:
+            self.flush()
+            assert eid not in [s["eid"] for s in self.sessions], \
+                f"Trials of session {eid} are not contiguous."
+            self._eid = eid
+        n_neurons = int(np.sum(data["space_attn_mask"] != 0))
+        for key, value in data.items():
+            if key in DERIVED_FIELDS:
+                continue
+            value = np.asarray(value)
+            if key in NEURON_FIELDS:
+                value = value[..., :n_neurons]
+            assert value.dtype != object, f"Field {key} can not be stored with a fixed dtype."
+            if key in SESSION_FIELDS:
+                first = self._session_buffer.setdefault(key, value)
+                assert np.array_equal(first, value, equal_nan=value.dtype.kind == "f"), \
+                    f"Field {key} differs between trials of session {eid}."
+                continue
+            self._buffer.setdefault(key, []).append(value)
+        self._buffer.setdefault("n_neurons", []).append(n_neurons)
+
+        self.index["session"].append(len(self.sessions))
+        self.index["choice"].append(np.asarray(data["choice"]).reshape(-1)[0])
+        self.index["block"].append(np.asarray(data["block"]).reshape(-1)[0])
+        self.index["n_neurons"].append(n_neurons)
+        self.index["n_time"].append(int(np.sum(data["time_attn_mask"] != 0)))
+
+    def flush(self):
+        if self._eid is None:
+            return
+        n_neurons = np.unique(self._buffer.pop("n_neurons"))
+        assert len(n_neurons) == 1, f"Session {self._eid} has a varying number of neurons."
+        fields, session_fields = sorted(self._buffer.keys()), sorted(self._session_buffer.keys())
+        if self.fields is None:
+            self.fields, self.session_fields = fields, session_fields
+        assert fields == self.fields and session_fields == self.session_fields, \
+            f"Session {self._eid} has fields {fields + session_fields}, expected {self.fields + self.session_fields}."
+
+        session_dir = os.path.join(self.save_dir, self._eid)
+        os.makedirs(session_dir, exist_ok=True)
+        n_trials, checksums = 0, {}
+        for key, values in self._buffer.items():
+            values = np.stack(values)
+            n_trials = len(values)
+            path = os.path.join(session_dir, f"{key}.npy")
+            np.save(path, values)
+            checksums[key] = {"bytes": os.path.getsize(path), "sha1": file_checksum(path)}
+        for key, value in self._session_buffer.items():
+            path = os.path.join(session_dir, f"{key}.npy")
+            np.save(path, value)
+            checksums[key] = {"bytes": os.path.getsize(path), "sha1": file_checksum(path)}
+
+        start = self.sessions[-1]["stop"] if self.sessions else 0
+        self.sessions.append({
+            "eid": self._eid,
+            "start": start,
+            "stop": start + n_trials,
+            "n_trials": n_trials,
+            "n_neurons": int(n_neurons[0]),
+            "checksums": checksums,
+        })
+        self._eid = None
+        self._buffer = {}
+        self._session_buffer = {}
+
+    def close(self):
+        self.flush()
+        manifest = {
+            "version": SHARD_VERSION,
+            "split": os.path.basename(os.path.normpath(self.save_dir)),
+            "n_trials": self.sessions[-1]["stop"] if self.sessions else 0,
+            "max_time_length": self.max_time_length,
+            "fields": self.fields or [],
+            "session_fields": self.session_fields or [],
+            "regions": self.regions,
+            "sessions": self.sessions,
+        }
+        with open(os.path.join(self.save_dir, MANIFEST_FILE), "w") as file:
+            json.dump(manifest, file, indent=2)
+        np.savez(
+            os.path.join(self.save_dir, INDEX_FILE),
+            session=np.asarray(self.index["session"], dtype=np.int32),
+            choice=np.asarray(self.index["choice"], dtype=np.int8),
+            block=np.asarray(self.index["block"], dtype=np.int8),
+            n_neurons=np.asarray(self.index["n_neurons"], dtype=np.int32),
+            n_time=np.asarray(self.index["n_time"], dtype=np.int32),
+        )
+        return manifest
+
+
+class ShardStore():
+    r"""
+    Read-only view over the columnar store of one split, restricted to ``eids``. Trials are
+    indexed globally in manifest order; ``__getitem__`` returns a dict of per-trial views.
+    The selected shards are validated against the manifest on open (see ``validate_manifest``).
+    """
+    def __init__(
+        self, data_dir: str, mode: str, eids: Optional[List[str]] = None, verify_checksums: bool = False
+    ):
+        self.root = os.path.join(data_dir, mode)
+        manifest = load_manifest(data_dir, mode)
+        sessions = manifest["sessions"]
+        self._n_sessions = len(sessions)
+        self._session_ids = np.arange(len(sessions))
+        if eids is not None:
+            eids = set(eids)
+            self._session_ids = np.array([i for i, s in enumerate(sessions) if s["eid"] in eids], dtype=np.int64)
+            sessions = [sessions[i] for i in self._session_ids]
+        self.sessions = sessions
+        validate_manifest(self.root, manifest, sessions, checksums=verify_checksums)
+        self.fields = manifest["fields"]
+        self.session_fields = manifest.get("session_fields", [])
+        self.regions = manifest.get("regions")
+        self.max_time_length = manifest["max_time_length"]
+        self.offsets = np.cumsum([0] + [s["n_trials"] for s in sessions])
+        self._arrays = None
+
+    def __getstate__(self):
+        # Memory maps are re-opened in every DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = [
+                {
+                    field: np.load(os.path.join(self.root, s["eid"], f"{field}.npy"), mmap_mode="c")
+                    for field in self.fields + self.session_fields
+                }
+                for s in self.sessions
+            ]
+        return self._arrays
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def trial_index(self):
+        r"""
+        Per-trial metadata of the selected sessions in store order, read from the trial index without
+        touching any trial data. ``eid`` holds the session of every trial; returns None for stores
+        exported without an index.
+        """
+        path = os.path.join(self.root, INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as index:
+            index = {field: index[field] for field in INDEX_FIELDS}
+        # Map manifest session ids to positions in the selection, -1 for sessions left out
+        positions = np.full(self._n_sessions, -1, dtype=np.int64)
+        positions[self._session_ids] = np.arange(len(self._session_ids))
+        keep = positions[index["session"]] >= 0
+        index = {field: values[keep] for field, values in index.items()}
+        index["session"] = positions[index["session"]]
+        index["eid"] = np.array([s["eid"] for s in self.sessions])[index["session"]]
+        return index
+
+    def locate(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Trial index {idx} out of range for {len(self)} trials.")
+        session_idx = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        return session_idx, int(idx - self.offsets[session_idx])
+
+    def locate_batch(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if np.any((indices < 0) | (indices >= len(self))):
+            raise IndexError(f"Trial indices out of range for {len(self)} trials.")
+        session_idxs = np.searchsorted(self.offsets, indices, side="right") - 1
+        return session_idxs, indices - self.offsets[session_idxs]
+
+    def __getitem__(self, idx):
+        session_idx, trial_idx = self.locate(idx)
+        arrays = self.arrays[session_idx]
+        trial = {field: arrays[field][trial_idx] for field in self.fields}
+        trial.update({field: arrays[field] for field in self.session_fields})
+        trial["eid"] = self.sessions[session_idx]["eid"]
+        trial["n_neurons"] = self.sessions[session_idx]["n_neurons"]
+        return trial
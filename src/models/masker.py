@@ -53,18 +53,20 @@ class Masker(nn.Module):
         spikes: torch.FloatTensor,                      # (bs, seq_len, n_channels)
         neuron_regions: np.ndarray = None,              # (bs, n_channels)
         mode: str = None,              
+        corrupt: bool = True,                           # zero / randomize the masked bins of ``spikes``
     ) -> Tuple[torch.FloatTensor, torch.LongTensor]:     # (bs, seq_len, n_channels), (bs, seq_len, n_channels)
         
         mode = copy.copy(self.mode) if mode is None else mode
+        device = spikes.device
 
         if not self.training and not self.force_active:
-            return spikes, torch.zeros_like(spikes).to(torch.int64)
+            return spikes, torch.zeros_like(spikes, dtype=torch.int64)
         elif self.target_regions is None:
-            return spikes, torch.zeros_like(spikes).to(torch.int64)
+            return spikes, torch.zeros_like(spikes, dtype=torch.int64)
         elif self.mask_regions is None:
-            return spikes, torch.zeros_like(spikes).to(torch.int64)
+            return spikes, torch.zeros_like(spikes, dtype=torch.int64)
         elif self.ratio == 0:
-            return spikes, torch.zeros_like(spikes).to(torch.int64)
+            return spikes, torch.zeros_like(spikes, dtype=torch.int64)
 
         if 'all' in self.mask_regions:
             self.mask_regions = list(np.unique(neuron_regions))
@@ -72,97 +74,109 @@ class Masker(nn.Module):
         if 'all' in self.target_regions:
             self.target_regions = list(np.unique(neuron_regions))
 
+        # All masks are drawn on the device of `spikes`, at their own granularity (time steps, 
+        # neurons, ...), and only broadcast to the spike shape at the end
         mask_ratio = self.ratio
         if mode in ["temporal", "random_token", "causal"]:
-            # Expand mask
+            # Expand mask; the span is drawn from torch's host generator, so reading it needs no device sync
             if torch.bernoulli(torch.tensor(self.expand_prob).float()):
-                timespan = torch.randint(1, self.max_timespan+1, (1, )).item() 
+                timespan = torch.randint(1, self.max_timespan+1, (1, )).item()
             else:
                 timespan = 1
             mask_ratio = mask_ratio/timespan
-            mask_probs = torch.full(spikes[:, :, 0].shape, mask_ratio) # (bs, seq_len)
 
             # for causal mask in iTransformer, we must expand the mask.
             if mode == "causal":
-                timespan = torch.randint(1, self.max_timespan+1, (1, )).item()     
+                timespan = torch.randint(1, self.max_timespan+1, (1, )).item()
                 # hack: hard set this to a number
                 mask_ratio = 0.01
-                mask_probs = torch.full(spikes[:, :, 0].shape, mask_ratio) # (bs, seq_len)
+            mask_probs = torch.full(spikes[:, :, 0].shape, mask_ratio, device=device) # (bs, seq_len)
                 
         elif mode == "neuron":
-            mask_probs = torch.full(spikes[:, 0].shape, mask_ratio)    # (bs, n_channels)
+            mask_probs = torch.full(spikes[:, 0].shape, mask_ratio, device=device)    # (bs, n_channels)
         elif mode == "random":
-            mask_probs = torch.full(spikes.shape, mask_ratio)     # (bs, seq_len, n_channels)
+            mask_probs = torch.full(spikes.shape, mask_ratio, device=device)     # (bs, seq_len, n_channels)
         elif mode == "co-smooth":
             assert self.channels is not None, "No channels to mask"
-            mask_probs = torch.zeros(spikes.shape[2])
-            for c in self.channels:
-                mask_probs[c] = 1
+            mask_probs = torch.zeros(spikes.shape[2], device=device)
+            mask_probs[self.channels] = 1
         elif mode == "forward-pred":
             assert self.timesteps is not None, "No time steps to mask"
-            mask_probs = torch.zeros(spikes.shape[1])
-            for t in self.timesteps:
-                mask_probs[t] = 1
+            mask_probs = torch.zeros(spikes.shape[1], device=device)
+            mask_probs[self.timesteps] = 1
         elif mode == "inter-region":
             assert neuron_regions is not None, "Can't mask region without brain region information"
             #assert self.mask_regions is not None, "No regions to mask"
             mask_regions = random.sample(self.mask_regions, self.n_mask_regions)
-            mask_probs = torch.zeros(spikes.shape[0],spikes.shape[2])
+            mask_probs = torch.zeros(spikes.shape[0],spikes.shape[2], device=device)
             for region in mask_regions:
-                region_indx = torch.tensor(neuron_regions == region, device=spikes.device)
-                mask_probs[region_indx] = 1      
+                region_indx = torch.as_tensor(neuron_regions == region, device=device)
+                mask_probs.masked_fill_(region_indx, 1)
         elif mode == "intra-region":
             assert neuron_regions is not None, "Can't mask region without brain region information"
             #assert self.target_regions is not None, "No target regions"
 
             target_regions = random.sample(self.target_regions, self.n_mask_regions)
-            mask_probs = torch.ones(spikes.shape[0],spikes.shape[2])
-            targets_mask = torch.zeros(spikes.shape[0],spikes.shape[2])
+            mask_probs = torch.ones(spikes.shape[0],spikes.shape[2], device=device)
+            targets_mask = torch.zeros(spikes.shape[0],spikes.shape[2], device=device, dtype=torch.bool)
             for region in target_regions:
-                region_indx = torch.tensor(neuron_regions == region, device=spikes.device)
-                mask_probs[region_indx] = mask_ratio
-                targets_mask[region_indx] = 1
+                region_indx = torch.as_tensor(neuron_regions == region, device=device)
+                mask_probs.masked_fill_(region_indx, mask_ratio)
+                targets_mask |= region_indx
         else:
             raise Exception(f"Masking mode {mode} not implemented")
         
         # Create mask
-        mask = torch.bernoulli(mask_probs).to(spikes.device)
+        mask = torch.bernoulli(mask_probs).bool()
 
         # Expand mask
         if mode in ["temporal", "random_token", "causal"]:
             if timespan > 1:
-                mask = self.expand_timesteps(mask, timespan)
+                mask = self.expand_timesteps(mask.float(), timespan)
 
             # Causal mask for iTransformer
             if self.causal_zero and mode == "causal":
-                _idx = torch.argmax(mask.int(), dim=1).int()
-                _target = mask.clone()
-                for j in range(mask.shape[0]):
-                    mask[j, _idx[j]:] = 1
+                _target = mask
+                mask = self.causal_fill(mask)
                     
-            mask = mask.unsqueeze(2).expand_as(spikes).bool()  
+            mask = mask.unsqueeze(2)
             
         elif mode in ["neuron","region","intra-region","inter-region"]:
-            mask = mask.unsqueeze(1).expand_as(spikes).bool()    
+            mask = mask.unsqueeze(1)
         elif mode in ["co-smooth"]:
-            mask = mask.unsqueeze(0).unsqueeze(1).expand_as(spikes).bool()
+            mask = mask[None, None]
         elif mode in ["forward-pred"]:
-            mask = mask.unsqueeze(0).unsqueeze(2).expand_as(spikes).bool()
-        else: # random
-            mask = mask.bool()          # (bs, seq_len, n_channels)
+            mask = mask[None, :, None]
             
         # Mask data
-        zero_idx = torch.bernoulli(torch.full(spikes.shape, self.zero_ratio)).to(spikes.device).bool() & mask
-        spikes[zero_idx] = 0
-        random_idx = torch.bernoulli(torch.full(spikes.shape, self.random_ratio)).to(spikes.device).bool() & mask & ~zero_idx
-        random_spikes = (spikes.max() * torch.rand(spikes.shape, device=spikes.device)).to(spikes.dtype)
-        spikes[random_idx] = random_spikes[random_idx]
+        if corrupt:
+            spikes = self.corrupt(spikes, mask.expand_as(spikes))
 
         if mode == "causal" and self.causal_zero:
-            targets_mask = _target.unsqueeze(2).expand_as(spikes).bool()
+            targets_mask = _target.unsqueeze(2)
+        elif mode == "intra-region":
+            targets_mask = mask & targets_mask.unsqueeze(1)
         else:
-            targets_mask = mask if mode != "intra-region" else mask & targets_mask.unsqueeze(1).expand_as(mask).bool().to(spikes.device)
-        return spikes, targets_mask.to(torch.int64) 
+            targets_mask = mask
+        return spikes, targets_mask.to(torch.int64).expand_as(spikes)
+
+    def corrupt(self, spikes, mask):
+        # Zero out / randomly set the masked bins without host syncs, skipping the per-bin draws
+        # when every masked bin is zeroed
+        if self.zero_ratio >= 1:
+            return spikes.masked_fill(mask, 0)
+        zero_idx = mask & (torch.rand(spikes.shape, device=spikes.device) < self.zero_ratio)
+        spikes = spikes.masked_fill(zero_idx, 0)
+        if self.random_ratio > 0:
+            random_idx = mask & ~zero_idx & (torch.rand(spikes.shape, device=spikes.device) < self.random_ratio)
+            random_spikes = (spikes.max() * torch.rand(spikes.shape, device=spikes.device)).to(spikes.dtype)
+            spikes = torch.where(random_idx, random_spikes, spikes)
+        return spikes
+
+    @staticmethod
+    def causal_fill(mask):
+        # Masks every step from the first masked one on, and the whole trial when no step is masked
+        return (mask.cumsum(1) > 0) | ~mask.any(1, keepdim=True)
 
     @staticmethod
     def expand_timesteps(mask, width=1):
@@ -1,6 +1,10 @@
+import math
 import numpy as np
+from functools import partial
 import torch
 from torch import nn
+import torch.nn.functional as F
+from utils.session_utils import get_registry_lookup
 
 STATIC_VARS = ["choice", "block"]
 DYNAMIC_VARS = ["wheel", "whisker"]
@@ -13,40 +17,77 @@ class StitchEncoder(nn.Module):
          scale: int=1,
          mod: str="spike",
          max_F: int=100,
+         pad_value: float=-1.,
+         right_size: bool=False,
+         rank: int=None,
     ):
         super().__init__()
 
         self.mod = mod
+        self.pad_value = pad_value
         self.P = n_channels
         self.max_F = max_F
         self.N = max(list(eid_list.values()))
+        # `rank` factorizes the spike stitcher into a per-session Linear(n_neurons, rank) and
+        # a projection shared across sessions
+        self.rank = rank if mod == "spike" else None
         stitcher_dict, project_dict = {}, {}
         for key, val in eid_list.items():
-            val = 1 if mod in STATIC_VARS + DYNAMIC_VARS else self.N
+            # `right_size` sizes the spike layers to the session's own neuron count instead of the max
+            if mod in STATIC_VARS + DYNAMIC_VARS:
+                val = 1
+            elif not right_size:
+                val = self.N
             mult = max_F if mod in STATIC_VARS else 1
+            if self.rank is not None:
+                stitcher_dict[str(key)] = nn.Linear(int(val), self.rank)
+                continue
             # token embedding layer
             stitcher_dict[str(key)] = nn.Linear(int(val), int(val) * 2 * mult)
             # projection layer
             project_dict[str(key)] = nn.Linear(int(val) * 2, n_channels)
         self.stitcher_dict = nn.ModuleDict(stitcher_dict)
-        self.project_dict = nn.ModuleDict(project_dict)
+        if self.rank is None:
+            self.project_dict = nn.ModuleDict(project_dict)
+        else:
+            self.project = nn.Linear(self.rank, n_channels)
         self.scale = scale
         self.act = nn.Softsign()
 
-    def forward(self, x, eid):
+    def forward(self, x, eid, session_idx=None):
         eid = np.array(eid)
         unique_eids = np.unique(eid)
+        if len(unique_eids) == 1:
+            # Single-session batch (see `SessionBatchSampler`): no gather / scatter
+            return self._forward_group(x, unique_eids[0])
         out = torch.zeros((len(x), self.max_F, self.P), device=x.device)
         for group_eid in unique_eids:
             mask = torch.tensor(np.argwhere(eid==group_eid), device=x.device).squeeze()
-            x_group = x[mask]
-            stitched = self.stitcher_dict[group_eid](x_group)
-            if self.mod in STATIC_VARS:
-                stitched = stitched.reshape(stitched.shape[0], -1, 2)
-            stitched = self.act(stitched) * self.scale
-            out[mask] = self.project_dict[group_eid](stitched)
+            out[mask] = self._forward_group(x[mask], group_eid)
         return out
 
+    def _forward_group(self, x, group_eid):
+        if self.mod == "spike" and x.size(-1) != self.stitcher_dict[group_eid].in_features:
+            stitched = self._narrow_linear(self.stitcher_dict[group_eid], x)
+        else:
+            stitched = self.stitcher_dict[group_eid](x)
+        if self.mod in STATIC_VARS:
+            stitched = stitched.reshape(stitched.shape[0], -1, 2)
+        stitched = self.act(stitched) * self.scale
+        if self.rank is not None:
+            return self.project(stitched)
+        return self.project_dict[group_eid](stitched)
+
+    def _narrow_linear(self, layer, x):
+        # Spikes padded only to the widest trial in the batch; the missing input columns 
+        # would all hold `pad_value`, so their contribution is folded into the bias.
+        # Columns past a right-sized layer's input are padding of the session and are dropped.
+        width = x.size(-1)
+        if width > layer.in_features:
+            return layer(x[..., :layer.in_features])
+        bias = layer.bias + self.pad_value * layer.weight[:, width:].sum(-1)
+        return F.linear(x, layer.weight[:, :width], bias)
+
 
 class StitchDecoder(nn.Module):
     def __init__(self,
@@ -54,6 +95,8 @@ class StitchDecoder(nn.Module):
          n_channels: int,
          mod:str="spike",
          max_F: int=100,
+         right_size: bool=False,
+         rank: int=None,
     ):
         super().__init__()
         
@@ -61,6 +104,11 @@ class StitchDecoder(nn.Module):
         self.max_F = max_F
         self.P = n_channels
         max_num_neuron = max(list(eid_list.values()))
+        # `rank` factorizes the spike decoder into a basis shared across sessions and a
+        # per-session Linear(rank, n_neurons)
+        self.rank = rank if mod == "spike" else None
+        if self.rank is not None:
+            self.basis = nn.Linear(n_channels, self.rank)
         stitch_decoder_dict = {}
         for key, val in eid_list.items():
             if mod in STATIC_VARS:
@@ -68,22 +116,197 @@ class StitchDecoder(nn.Module):
             elif mod in DYNAMIC_VARS:
                 val, mult = OUTPUT_DIM[mod], 1
             else:
-                val, mult = max_num_neuron, 1
-            stitch_decoder_dict[str(key)] = nn.Linear(n_channels * mult, val)
+                val, mult = (val if right_size else max_num_neuron), 1
+            stitch_decoder_dict[str(key)] = nn.Linear(self.rank or n_channels * mult, val)
         self.stitch_decoder_dict = nn.ModuleDict(stitch_decoder_dict)
         self.N = max_num_neuron if mod == "spike" else val
 
-    def forward(self, x, eid):
+    def forward(self, x, eid, n_out=None, session_idx=None):
+        # `n_out` narrows the spike outputs to the width of the (dynamically padded) batch
         x = x.reshape((len(eid), -1, self.P))
+        if self.rank is not None:
+            x = self.basis(x)
         B, T, _ = x.size()
+        n_out = self.N if n_out is None else n_out
         eid = np.array(eid)
         unique_eids = np.unique(eid)
-        out = torch.zeros((B,T,self.N), device=x.device)
+        if len(unique_eids) == 1:
+            return self._project(self.stitch_decoder_dict[unique_eids[0]], x, n_out)
+        out = torch.zeros((B,T,n_out), device=x.device)
         for group_eid in unique_eids:
             mask = torch.tensor(np.argwhere(eid==group_eid), device=x.device).squeeze()
-            x_group = x[mask]
-            out[mask] = self.stitch_decoder_dict[group_eid](x_group)
+            out[mask] = self._project(self.stitch_decoder_dict[group_eid], x[mask], n_out)
+        return out
+
+    def _project(self, layer, x, n_out):
+        out = F.linear(x, layer.weight[:n_out], layer.bias[:n_out])
+        if out.size(-1) < n_out:
+            # Right-sized session: the columns past its neurons are padding, masked out of the loss
+            out = F.pad(out, (0, n_out - out.size(-1)))
         return out
-    
-    
 
+
+# State dict keys of the per-session Linear layers of the ModuleDict stitchers, and of the
+# matching [S, in, out] weights / [S, out] biases of the stacked stitchers
+STACKED_KEYS = {
+    "stitcher_dict": ("stitch_weight", "stitch_bias"),
+    "project_dict": ("project_weight", "project_bias"),
+    "stitch_decoder_dict": ("decoder_weight", "decoder_bias"),
+}
+
+
+def stack_stitcher_state_dict(state_dict, prefix, eids):
+    r"""
+    Converts the per-session ``{prefix}{dict}.{eid}.weight / bias`` entries of a ModuleDict stitcher in
+    ``state_dict`` (in place) into the stacked ``{prefix}{name}`` entries, with sessions in ``eids`` order.
+    """
+    for dict_name, (weight_name, bias_name) in STACKED_KEYS.items():
+        weight_keys = [f"{prefix}{dict_name}.{eid}.weight" for eid in eids]
+        if not all(key in state_dict for key in weight_keys):
+            continue
+        state_dict[prefix + weight_name] = torch.stack([state_dict.pop(key).t() for key in weight_keys])
+        state_dict[prefix + bias_name] = torch.stack([
+            state_dict.pop(f"{prefix}{dict_name}.{eid}.bias") for eid in eids
+        ])
+    return state_dict
+
+
+def unstack_stitcher_state_dict(state_dict, prefix, eids):
+    r"""
+    Inverse of ``stack_stitcher_state_dict``: splits the stacked entries of a stitcher into the
+    per-session entries the ModuleDict stitchers load.
+    """
+    for dict_name, (weight_name, bias_name) in STACKED_KEYS.items():
+        if prefix + weight_name not in state_dict:
+            continue
+        weight, bias = state_dict.pop(prefix + weight_name), state_dict.pop(prefix + bias_name)
+        for idx, eid in enumerate(eids):
+            state_dict[f"{prefix}{dict_name}.{eid}.weight"] = weight[idx].t().contiguous()
+            state_dict[f"{prefix}{dict_name}.{eid}.bias"] = bias[idx]
+    return state_dict
+
+
+class StackedStitcher(nn.Module):
+    r"""
+    Base class of the stacked stitchers: all session weights live in one [S, in, out] parameter and
+    are applied with a single batched matmul after gathering the rows of the sessions in the batch.
+    Checkpoints of the ModuleDict stitchers load directly (see ``stack_stitcher_state_dict``).
+    """
+    def __init__(self, eid_list: dict, right_size: bool=False):
+        super().__init__()
+        if right_size:
+            raise ValueError("Stacked stitchers share one max-sized shape; use the dict stitchers with `right_size`.")
+        self.eids = [str(key) for key in eid_list.keys()]
+        self.eid_to_pos = {eid: pos for pos, eid in enumerate(self.eids)}
+        self.register_buffer("session_lookup", get_registry_lookup(self.eids), persistent=False)
+
+    def _stacked_linear(self, n_in, n_out):
+        # Same initialization as `nn.Linear`
+        bound = 1 / math.sqrt(n_in)
+        weight = nn.Parameter(torch.empty(len(self.eids), n_in, n_out).uniform_(-bound, bound))
+        bias = nn.Parameter(torch.empty(len(self.eids), n_out).uniform_(-bound, bound))
+        return weight, bias
+
+    def positions(self, eid, session_idx, device):
+        # Positions of the batch sessions in the stacked parameters, from the registry ids when given
+        if session_idx is None:
+            return torch.tensor([self.eid_to_pos[str(e)] for e in np.atleast_1d(eid)], device=device)
+        pos = self.session_lookup[session_idx.reshape(-1)]
+        # Sessions outside `eid_list` map past the last position (see `get_registry_lookup`), which the
+        # stacked gathers reject on any device; the check on host tensors names the sessions
+        if pos.device.type == "cpu" and bool((pos == len(self.eids)).any()):
+            missing = session_idx.reshape(-1)[pos == len(self.eids)].unique().tolist()
+            raise KeyError(f"Sessions with registry ids {missing} have no stitcher weights.")
+        return pos
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        stack_stitcher_state_dict(state_dict, prefix, self.eids)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class StackedStitchEncoder(StackedStitcher):
+    def __init__(self, 
+         eid_list: dict,
+         n_channels: int,
+         scale: int=1,
+         mod: str="spike",
+         max_F: int=100,
+         pad_value: float=-1.,
+         right_size: bool=False,
+    ):
+        super().__init__(eid_list, right_size)
+
+        self.mod = mod
+        self.pad_value = pad_value
+        self.P = n_channels
+        self.max_F = max_F
+        self.N = max(list(eid_list.values()))
+        val = 1 if mod in STATIC_VARS + DYNAMIC_VARS else self.N
+        mult = max_F if mod in STATIC_VARS else 1
+        # token embedding layer
+        self.stitch_weight, self.stitch_bias = self._stacked_linear(int(val), int(val) * 2 * mult)
+        # projection layer
+        self.project_weight, self.project_bias = self._stacked_linear(int(val) * 2, n_channels)
+        self.scale = scale
+        self.act = nn.Softsign()
+
+    def forward(self, x, eid, session_idx=None):
+        pos = self.positions(eid, session_idx, x.device)
+        weight, bias = self.stitch_weight[pos], self.stitch_bias[pos]
+        width = x.size(-1)
+        if self.mod == "spike" and width < self.N:
+            # Missing input columns would hold `pad_value`; fold them into the bias
+            bias = bias + self.pad_value * weight[:, width:].sum(1)
+            weight = weight[:, :width]
+        stitched = torch.baddbmm(bias[:,None,:], x.reshape(len(pos), -1, width), weight)
+        if self.mod in STATIC_VARS:
+            stitched = stitched.reshape(stitched.shape[0], -1, 2)
+        stitched = self.act(stitched) * self.scale
+        return torch.baddbmm(self.project_bias[pos][:,None,:], stitched, self.project_weight[pos])
+
+
+class StackedStitchDecoder(StackedStitcher):
+    def __init__(self,
+         eid_list: list,
+         n_channels: int,
+         mod:str="spike",
+         max_F: int=100,
+         right_size: bool=False,
+    ):
+        super().__init__(eid_list, right_size)
+
+        self.mod = mod
+        self.max_F = max_F
+        self.P = n_channels
+        max_num_neuron = max(list(eid_list.values()))
+        val = OUTPUT_DIM[mod] if mod in STATIC_VARS + DYNAMIC_VARS else max_num_neuron
+        self.decoder_weight, self.decoder_bias = self._stacked_linear(n_channels, val)
+        self.N = max_num_neuron if mod == "spike" else val
+
+    def forward(self, x, eid, n_out=None, session_idx=None):
+        x = x.reshape((len(eid), -1, self.P))
+        n_out = self.N if n_out is None else n_out
+        pos = self.positions(eid, session_idx, x.device)
+        weight, bias = self.decoder_weight[pos][..., :n_out], self.decoder_bias[pos][..., :n_out]
+        return torch.baddbmm(bias[:,None,:], x, weight)
+
+
+# Stitcher implementations selectable with `embedder.stitcher`; `lowrank` is the dict stitchers
+# with their spike layers factorized to `embedder.rank`
+STITCHERS = {
+    "dict": (StitchEncoder, StitchDecoder),
+    "stacked": (StackedStitchEncoder, StackedStitchDecoder),
+    "lowrank": (StitchEncoder, StitchDecoder),
+}
+
+
+def get_stitchers(config):
+    r"""
+    Encoder / decoder stitcher classes selected by the embedder ``config``, with its options bound.
+    """
+    stitcher = config.stitcher if "stitcher" in config else "dict"
+    stitch_encoder, stitch_decoder = STITCHERS[stitcher]
+    kwargs = {"right_size": config.right_size if "right_size" in config else False}
+    if stitcher == "lowrank":
+        kwargs["rank"] = config.rank if "rank" in config else 32
+    return partial(stitch_encoder, **kwargs), partial(stitch_decoder, **kwargs)
@@ -9,22 +9,21 @@ from transformers.activations import ACT2FN
 ACT2FN["softsign"] = nn.Softsign
 from utils.config_utils import DictConfig, update_config
 from multi_modal.mm_utils import ScaleNorm, MLP, Attention
-from models.stitcher import StitchEncoder, StitchDecoder
+from models.stitcher import get_stitchers
+from utils.session_utils import SESSION_REGISTRY, get_batch_session_idx, get_registry_lookup, gather_session_params
 
 DEFAULT_CONFIG = "src/configs/multi_modal/mm.yaml"
 
-PROJ_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-with open(f"{PROJ_DIR}/data/train_eids.txt") as file:
-    INCLUDE_EIDS = [line.rstrip() for line in file]
-with open(f"{PROJ_DIR}/data/test_eids.txt") as file:
-    INCLUDE_EIDS += [line.rstrip() for line in file]
+# Session embeddings are indexed by the registry ids the loader emits as `session_idx`
+INCLUDE_EIDS = SESSION_REGISTRY
 
 STATIC_VARS = ["choice", "block"]
 
 
 class EncoderEmbeddingLayer(nn.Module):
     def __init__(
-        self, hidden_size, n_channels, config: DictConfig, stitching=False, eid_list=None, mod=None, max_F=100
+        self, hidden_size, n_channels, config: DictConfig, stitching=False, eid_list=None, mod=None, max_F=100,
+        patch_size=1,
     ):
         super().__init__()
 
@@ -45,8 +44,14 @@ class EncoderEmbeddingLayer(nn.Module):
 
         self.dropout = nn.Dropout(config.dropout)
 
+        # `patch_size` consecutive time steps are merged into one token after the stitcher
+        self.patch_size = patch_size
+        if patch_size > 1:
+            self.patch_proj = nn.Linear(patch_size * hidden_size, hidden_size)
+
         if stitching:
-            self.mod_stitch_encoder = StitchEncoder(
+            stitch_encoder, _ = get_stitchers(config)
+            self.mod_stitch_encoder = stitch_encoder(
                 eid_list=eid_list, n_channels=hidden_size, mod=mod, max_F=max_F
             )
         else:
@@ -61,26 +66,25 @@ class EncoderEmbeddingLayer(nn.Module):
         inputs, inputs_timestamp, inputs_modality, eid = \
         d["inputs"], d["inputs_timestamp"], d["inputs_modality"], d["eid"]
         B, N, D = inputs.size()
-        N = self.max_F
+        N = self.max_F // self.patch_size
+        session_idx = get_batch_session_idx(d, inputs.device)
         if hasattr(self, "mod_stitch_encoder"):
-            x = self.mod_stitch_encoder(inputs, eid)
+            x = self.mod_stitch_encoder(inputs, eid, session_idx)
         else:
             x = self.token_embed(inputs)
             x = self.act(x) * self.scale
             x = self.projection(x)
 
-        x_embed = self.mod_emb(inputs_modality)[None,None,:].expand(B,N,-1).clone()
+        if self.patch_size > 1:
+            x = self.patch_proj(x.reshape(B, N, -1))
 
+        # Modality and session embeddings are summed at [B, 1, hidden] and broadcast once over
+        # the tokens; without positions the result stays an expanded view
+        x_embed = (self.mod_emb(inputs_modality) + self.session_emb(session_idx))[:,None,:]
         if self.pos:
-            x_embed += self.pos_embed(inputs_timestamp)
-
-        eid = np.array(eid)
-        unique_eids = np.unique(eid)
-        for group_eid in unique_eids:
-            mask = torch.tensor(np.argwhere(eid==group_eid), device=x.device).squeeze()
-            if mask.dim() > 0:
-                session_idx = torch.tensor(self.eid_to_indx[group_eid]).to(x.device, torch.int64)
-                x_embed[mask] += self.session_emb(session_idx)[None,None,:].expand(mask.size(0),N,-1)
+            x_embed = x_embed + self.pos_embed(inputs_timestamp)
+        else:
+            x_embed = x_embed.expand(B,N,-1)
 
         return self.dropout(x), x_embed
 
@@ -104,52 +108,85 @@ class EncoderEmbedding(nn.Module):
         self.max_F = max_F
         self.n_channel = n_channel
         self.output_channel = output_channel
+        self.mod = mod
+        # Static variables are per-trial scalars; `static_tokens` encodes them with a few tokens instead of max_F
+        static_tokens = config.embedder.static_tokens if "static_tokens" in config.embedder else None
+        patch_size = config.embedder.patch_size if "patch_size" in config.embedder else 1
+        self.patch_size = 1 if mod in STATIC_VARS else patch_size
+        assert max_F % self.patch_size == 0, f"max_F ({max_F}) is not a multiple of patch_size ({patch_size})."
+        # Encoder tokens of the modality, and the time steps they cover
+        self.n_tokens = static_tokens if (mod in STATIC_VARS and static_tokens) else max_F // self.patch_size
+        self.n_steps = self.n_tokens * self.patch_size
 
         self.embedder = EncoderEmbeddingLayer(
-            self.hidden_size, self.n_channel, config.embedder, stitching, eid_list, mod, max_F
+            self.hidden_size, self.n_channel, config.embedder, stitching, eid_list, mod, self.n_steps,
+            self.patch_size,
         )
+        if self.patch_size > 1:
+            self.unpatch_proj = nn.Linear(self.hidden_size, self.patch_size * self.hidden_size)
 
         if stitching:
-            self.mod_stitcher_proj_dict = StitchDecoder(
+            _, stitch_decoder = get_stitchers(config.embedder)
+            self.mod_stitcher_proj_dict = stitch_decoder(
                 eid_list = eid_list, n_channels = self.n_channel, mod = mod, max_F = max_F
             )
             if mod in STATIC_VARS:
                 mod_static_weight_dict = {}
                 for key, val in eid_list.items():
-                    mod_static_weight_dict[str(key)] = nn.Parameter(torch.rand(self.max_F))
+                    mod_static_weight_dict[str(key)] = nn.Parameter(torch.rand(self.n_tokens))
                 self.mod_static_weight_dict = nn.ParameterDict(mod_static_weight_dict)
+                self.register_buffer(
+                    "static_weight_lookup", get_registry_lookup(list(self.mod_static_weight_dict.keys())),
+                    persistent=False,
+                )
         else:
             self.out = nn.Linear(self.hidden_size, self.output_channel)
 
     def forward(self, d : Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:    
+
+        if self.n_steps < self.max_F:
+            # Compact static tokens take the first time steps; `targets_mask` stays per time step
+            d["inputs_timestamp"] = d["inputs_timestamp"][:, :self.n_tokens]
+            d["inputs_mask"] = d["inputs_mask"][:, :self.n_tokens]
+        if self.patch_size > 1:
+            # A patch is masked when its first time step is, and all of its steps are then
+            # predicted, so the masking ratio is kept and no masked step is visible
+            p = self.patch_size
+            d["inputs_timestamp"] = d["inputs_timestamp"][:, ::p] // p
+            d["inputs_mask"] = d["inputs_mask"][:, ::p]
+            d["targets_mask"] = d["targets_mask"][:, ::p].repeat_interleave(p, 1) & d["inputs_attn_mask"]
                         
         x, x_emb = self.embedder(d)
         d["x"], d["emb"], d["gt"] = x, x_emb, d["targets"]
         
         return d
 
+    def unpatch(self, y: torch.Tensor) -> torch.Tensor:
+        # [B, n_tokens, hidden] encoder outputs of the modality -> [B, n_steps, hidden]
+        if self.patch_size == 1:
+            return y
+        return self.unpatch_proj(y).reshape(y.size(0), self.n_steps, -1)
+
     def out_proj(self, 
-        mod_idx: int, d: Dict[str, torch.Tensor], y: torch.Tensor, 
-        mod_mask: torch.Tensor, n_mod: int,
+        d: Dict[str, torch.Tensor], y: torch.Tensor, mod_slice: slice,
     ) -> Dict[str, torch.Tensor]: 
 
         B, N, P = y.size()
 
-        y_mod = y[mod_mask == mod_idx]
+        # `mod_slice` is the contiguous block of the modality in the sequence: a view, no gather
+        y_mod = self.unpatch(y[:, mod_slice])
         
         if hasattr(self, "mod_stitcher_proj_dict"):
+            session_idx = get_batch_session_idx(d, y.device)
             if hasattr(self, "mod_static_weight_dict"):
-                weight = torch.zeros_like(y_mod.reshape(B,-1,P), device=y.device) 
-                eid = np.array(d["eid"])
-                unique_eids = np.unique(eid)
-                for group_eid in unique_eids:
-                    mask = torch.tensor(np.argwhere(eid==group_eid), device=y.device).squeeze()
-                    if mask.dim() > 0:
-                        weight[mask] = self.mod_static_weight_dict[group_eid][None,:,None].expand(mask.size(0),-1,P)
+                weight = gather_session_params(
+                    self.mod_static_weight_dict, self.static_weight_lookup, session_idx
+                )[:,:,None]
                 y_mod = torch.sum(
                     y_mod.reshape(B,-1,P) * weight, 1
                 ).reshape(B,-1)
-            preds = self.mod_stitcher_proj_dict(y_mod, d["eid"])
+            n_out = d["targets"].size(-1) if self.mod == "spike" else None
+            preds = self.mod_stitcher_proj_dict(y_mod, d["eid"], n_out, session_idx)
             d["preds"] = preds.reshape((B,-1,preds.size()[-1])) \
                 if not hasattr(self, "mod_static_weight_dict") else preds
         else:
@@ -18,7 +18,8 @@ ACT2FN["softsign"] = nn.Softsign
 from utils.config_utils import DictConfig, update_config
 from models.masker import Masker
 from multi_modal.encoder_embeddings import EncoderLayer
-from models.stitcher import StitchDecoder
+from models.stitcher import get_stitchers
+from utils.session_utils import get_batch_session_idx, get_registry_lookup, gather_session_params
 from models.model_output import ModelOutput
 from multi_modal.mm_utils import create_context_mask
 
@@ -26,6 +27,7 @@ DEFAULT_CONFIG = "src/configs/multi_modal/mm.yaml"
 
 STATIC_VARS = ["choice", "block"]
 DYNAMIC_VARS = ["wheel", "whisker"]
+MIXED_SCHEMES = ["encoding", "decoding", "self-spike", "self-behavior", "random_token"]
 
 @dataclass
 class MultiModalOutput(ModelOutput):
@@ -59,6 +61,7 @@ class MultiModal(nn.Module):
         self.n_layers = config.encoder.transformer.n_layers
         self.hidden_size = config.encoder.transformer.hidden_size
         self.max_F = config.encoder.embedder.max_F
+        _, self.stitch_decoder = get_stitchers(config.encoder.embedder)
 
         self.encoder_modalities = set(encoder_embeddings.keys())
         self.encoder_embeddings = nn.ModuleDict(encoder_embeddings)
@@ -78,6 +81,17 @@ class MultiModal(nn.Module):
         )
         self.encoder_norm = nn.LayerNorm(self.hidden_size) 
 
+        # MAE-style path: positions masked in every sample skip the encoder and are decoded
+        # from mask queries by a few light layers
+        transformer_config = config.encoder.transformer
+        self.drop_masked = transformer_config.drop_masked if "drop_masked" in transformer_config else False
+        if self.drop_masked:
+            n_decoder_layers = transformer_config.n_decoder_layers if "n_decoder_layers" in transformer_config else 1
+            self.decoder = nn.ModuleList(
+                [EncoderLayer(idx, transformer_config) for idx in range(n_decoder_layers)]
+            )
+            self.decoder_norm = nn.LayerNorm(self.hidden_size)
+
         self.num_class = {
             "spike": None, "wheel": 1, "whisker": 1, "choice": 2, "block": 3,
         }
@@ -112,9 +126,10 @@ class MultiModal(nn.Module):
         device = "cuda" if torch.cuda.is_available() else "cpu"
 
         self.mod_stitcher_proj_dict, self.mod_static_weight_dict = {}, {}
+        self.mod_static_weight_lookup = {}
         self.mod_token_weight_dict = {}
         for mod in mod_list:
-            self.mod_stitcher_proj_dict[mod] = StitchDecoder(
+            self.mod_stitcher_proj_dict[mod] = self.stitch_decoder(
                 eid_list = _eid_list, n_channels = n_channels, mod = mod,
             ).to(device)
             if mod in STATIC_VARS:
@@ -122,30 +137,35 @@ class MultiModal(nn.Module):
                 for key, val in _eid_list.items():
                     tmp_dict[str(key)] = nn.Parameter(torch.rand(self.max_F))
                 self.mod_static_weight_dict[mod] = nn.ParameterDict(tmp_dict).to(device)
+                self.mod_static_weight_lookup[mod] = get_registry_lookup(
+                    list(self.mod_static_weight_dict[mod].keys())
+                ).to(device)
                 
     
     def cat_encoder_tensors(self, mod_dict: Dict[str, torch.Tensor]) -> Tuple[torch.Tensor]:
         encoder_tokens, encoder_emb, input_timestamp = [], [], []
-        encoder_mask, mod_mask = [], []
+        encoder_mask, mod_slices = [], {}
 
+        start_idx = 0
         for mod, d in mod_dict.items():
             encoder_tokens.append(d["x"])
             encoder_emb.append(d["emb"])
             input_timestamp.append(d["inputs_timestamp"])
             encoder_mask.append(d["inputs_mask"])
-            mod_mask.append(torch.full_like(d["inputs_mask"], self.mod_to_indx[mod]))
+            # Every modality occupies a contiguous block of the sequence
+            mod_slices[mod] = slice(start_idx, start_idx + d["inputs_mask"].size(1))
+            start_idx = mod_slices[mod].stop
     
         encoder_tokens = torch.cat(encoder_tokens, dim=1)
         encoder_emb = torch.cat(encoder_emb, dim=1)
         input_timestamp = torch.cat(input_timestamp, dim=1)
         encoder_mask = torch.cat(encoder_mask, dim=1)
-        mod_mask = torch.cat(mod_mask, dim=1).to(torch.int16)
-        return encoder_tokens, encoder_emb, input_timestamp, encoder_mask, mod_mask
+        return encoder_tokens, encoder_emb, input_timestamp, encoder_mask, mod_slices
 
     
     def forward_mask_encoder(self, mod_dict: Dict[str, Dict[str, torch.Tensor]]) -> Tuple[torch.Tensor]:
         
-        encoder_tokens, encoder_emb, input_timestamp, encoder_mask, mod_mask = \
+        encoder_tokens, encoder_emb, input_timestamp, encoder_mask, mod_slices = \
         self.cat_encoder_tensors(mod_dict)
 
         # encoder_tokens: [B, N, D]
@@ -158,7 +178,7 @@ class MultiModal(nn.Module):
             self.mask_token.expand_as(encoder_tokens),
             encoder_tokens,
         )       
-        return encoder_tokens, encoder_emb, input_timestamp, encoder_mask, mod_mask
+        return encoder_tokens, encoder_emb, input_timestamp, encoder_mask, mod_slices
 
 
     def forward_encoder(
@@ -180,6 +200,46 @@ class MultiModal(nn.Module):
 
         return x
 
+
+    def forward_drop_encoder(
+        self, 
+        x: torch.Tensor, 
+        encoder_emb: torch.Tensor,
+        input_timestamp: torch.LongTensor,
+        mod_slices: Dict[str, slice],
+        dropped_mods: List[str],
+    ) -> torch.Tensor:
+        r"""
+        Runs the encoder on the modalities that are visible in at least one sample only; the modalities
+        masked in the whole batch (``dropped_mods``, e.g. the masked modalities of the encoding / decoding 
+        schemes) are re-inserted as mask queries (mask token + embeddings) and attended by the decoder layers.
+        The kept modalities are known on the host (see ``mark_fully_masked``), so they are cut out and put
+        back with slices, without index tensors or host syncs.
+        """
+        queries = self.mask_token + encoder_emb
+        kept = [mod_slice for mod, mod_slice in mod_slices.items() if mod not in dropped_mods]
+        if len(kept) > 0:
+            visible = self.forward_encoder(
+                torch.cat([x[:, mod_slice] for mod_slice in kept], dim=1),
+                input_timestamp=torch.cat([input_timestamp[:, mod_slice] for mod_slice in kept], dim=1),
+            ).to(queries.dtype)
+            chunks, start_idx = [], 0
+            for mod, mod_slice in mod_slices.items():
+                if mod in dropped_mods:
+                    chunks.append(queries[:, mod_slice])
+                else:
+                    n_tokens = mod_slice.stop - mod_slice.start
+                    chunks.append(visible[:, start_idx:start_idx + n_tokens])
+                    start_idx += n_tokens
+            x = torch.cat(chunks, dim=1)
+        else:
+            x = queries
+
+        for layer in self.decoder:
+            x = layer(x, mask=None, timestamp=input_timestamp)
+
+        return self.decoder_norm(x)
+
     
     def forward_loss(self, 
         output_mod_dict: Dict[str, Any]
@@ -196,13 +256,16 @@ class MultiModal(nn.Module):
 
             mod_type = self.mod_type[mod]
             if mod_type != "static":
-                pad_mask = targets != -1.
-                targets_mask = torch.mul(targets_mask, pad_mask)
-                n_examples = targets_mask.sum()
+                assert preds.shape == targets.shape == targets_mask.shape, \
+                f"shape mismatch in computing loss: preds ({preds.shape}) vs. targets ({targets.shape})."
+                # Gather the masked time steps first, so the element-wise loss and its gradient 
+                # only cover them; padded neurons are then masked within the gathered steps
+                token_mask = output_mod_dict[mod]["targets_mask"].bool()
+                masked_preds, masked_targets = preds[token_mask], targets[token_mask]
+                pad_mask = masked_targets != -1.
+                n_examples = pad_mask.sum()
                 if n_examples != 0:                        
-                    assert preds.shape == targets.shape == targets_mask.shape, \
-                    f"shape mismatch in computing loss: preds ({preds.shape}) vs. targets ({targets.shape})."
-                    loss = (self.mod_loss[mod_type](preds, targets)*targets_mask).sum()/n_examples
+                    loss = (self.mod_loss[mod_type](masked_preds, masked_targets)*pad_mask).sum()/n_examples
                 else:
                     loss = torch.zeros(1, device=targets.device, requires_grad=True).squeeze()
             else:
@@ -235,6 +298,20 @@ class MultiModal(nn.Module):
         return loss, mod_loss, mod_n_examples, mod_preds, mod_targets, static_targets, static_preds
 
 
+    def unpatch_encoder_output(
+        self, mod_dict: Dict[str, Dict[str, torch.Tensor]], y: torch.Tensor
+    ) -> torch.Tensor:
+        # Splits the encoder outputs into the tokens of each input modality and unpatches them to time steps
+        chunks, start_idx = [], 0
+        for mod in mod_dict:
+            if mod not in self.encoder_embeddings:
+                continue
+            n_tokens = self.encoder_embeddings[mod].n_tokens
+            chunks.append(self.encoder_embeddings[mod].unpatch(y[:, start_idx:start_idx + n_tokens]))
+            start_idx += n_tokens
+        return torch.cat(chunks, dim=1)
+
+
     def forward_unimodal_output(
         self, mod_dict: Dict[str, Dict[str, torch.Tensor]], y
     ) -> MultiModalOutput:
@@ -248,31 +325,36 @@ class MultiModal(nn.Module):
         else:
             mod_list = self.avail_beh
 
+        if any(emb.patch_size > 1 for emb in self.encoder_embeddings.values()):
+            y = self.unpatch_encoder_output(mod_dict, y)
+
         B, N, P = y.size()
 
         for mod in mod_list:
 
             output_mod_dict[mod] = {}
             if hasattr(self, "mod_stitcher_proj_dict"):
-                y_mod = y.clone()
+                y_mod = y
+                session_idx = get_batch_session_idx(mod_dict["spike"], y.device)
                 if hasattr(self, "mod_static_weight_dict") and (mod in STATIC_VARS):
-                    weight = torch.zeros_like(y, device=y.device) 
-                    eid = np.array(eid)
-                    unique_eids = np.unique(eid)
-                    for group_eid in unique_eids:
-                        mask = torch.tensor(np.argwhere(eid==group_eid), device=y.device).squeeze()
-                        if mask.dim() > 0:
-                            weight[mask] = self.mod_static_weight_dict[mod][group_eid][None,:,None].expand(mask.size(0),N,P)
+                    weight = gather_session_params(
+                        self.mod_static_weight_dict[mod], self.mod_static_weight_lookup[mod], session_idx
+                    )[:,:,None]
                     y_mod = torch.sum(y.reshape(B,N,P) * weight, 1).reshape(B,-1)
 
                 if self.model_mode == "encoding":
-                    chunks = []
-                    for beh_idx in range(len(self.avail_beh)): 
-                        start_idx = beh_idx * self.max_F
-                        end_idx = start_idx + self.max_F
-                        chunks.append(y_mod[:, start_idx:end_idx])
+                    chunks, start_idx = [], 0
+                    for beh in self.avail_beh: 
+                        n_tokens = self.encoder_embeddings[beh].n_steps
+                        chunk = y_mod[:, start_idx:start_idx + n_tokens]
+                        start_idx += n_tokens
+                        if n_tokens < self.max_F:
+                            # Compact static tokens are repeated over the time steps
+                            chunk = chunk[:, torch.arange(self.max_F, device=y.device) * n_tokens // self.max_F]
+                        chunks.append(chunk)
                     y_mod = torch.cat(chunks, dim=2)
-                preds = self.mod_stitcher_proj_dict[mod](y_mod, eid) 
+                n_out = mod_dict[mod]["targets"].size(-1) if mod == "spike" else None
+                preds = self.mod_stitcher_proj_dict[mod](y_mod, eid, n_out, session_idx) 
                 output_mod_dict[mod]["preds"] = preds.reshape((B,self.max_F,-1)) \
                     if mod not in STATIC_VARS else preds
 
@@ -283,43 +365,37 @@ class MultiModal(nn.Module):
 
 
     def _prepare_mixed_masking(self, mod_dict):
-                    
-        tmp = mod_dict["spike"]["inputs"].clone()
-        
-        masking_schemes = [
-            "encoding", "decoding", "self-spike", "self-behavior", "random_token"
-        ]
-        selected_schemes = np.random.choice(
-            masking_schemes, size=tmp.size()[0], replace=True
-        )
-        all_ones = torch.ones_like(tmp).to(tmp.device, torch.int64)
-        all_zeros = all_ones * 0.
-        
-        mask_map = {}
+        r"""
+        Draws a masking scheme per sample and returns, for every modality, a [n_schemes, B, T] table 
+        of its masks under each scheme, together with the scheme ids.
+        """
+        inputs = mod_dict["spike"]["inputs"]
+        B, T = inputs.size()[:2]
+        scheme_idx = torch.randint(len(MIXED_SCHEMES), (B,), device=inputs.device)
+
+        # Independent temporal masker draws, each with its own expand / timespan draw: one for the
+        # self-spike and one for the random_token masks, and one self-behavior mask per behavior
+        empty = inputs.new_empty(B, T, 1)
+        def draw():
+            return self.masker(empty, None, "temporal", corrupt=False)[1][..., 0]
+        self_spike, random_token = draw(), draw()
+        all_ones, all_zeros = torch.ones_like(self_spike), torch.zeros_like(self_spike)
+
+        # Rows follow MIXED_SCHEMES: encoding, decoding, self-spike, self-behavior, random_token
+        mask_table = {}
         for mod in self.avail_mod:
             if mod == "spike":
-                mask_map[mod] = {
-                    "encoding": all_ones,
-                    "decoding": all_zeros,
-                    "self-spike": self.masker(tmp, None, "temporal")[1],
-                    "self-behavior": all_zeros,
-                    "random_token": self.masker(tmp, None, "temporal")[1],
-                }
+                mask_table[mod] = torch.stack([all_ones, all_zeros, self_spike, all_zeros, random_token])
             elif mod in DYNAMIC_VARS+STATIC_VARS:
-                mask_map[mod] = {
-                    "encoding": 1 - mask_map["spike"]["encoding"],
-                    "decoding": 1 - mask_map["spike"]["decoding"],
-                    "self-spike": all_zeros,
-                    "self-behavior": self.masker(tmp, None, "temporal")[1],
-                    "random_token": mask_map["spike"]["random_token"],
-                }
-        return mask_map, selected_schemes
+                mask_table[mod] = torch.stack([all_zeros, all_ones, all_zeros, draw(), random_token])
+        return mask_table, scheme_idx
 
     
     def forward(self, mod_dict: Dict[str, Dict[str, torch.Tensor]]) -> MultiModalOutput:
 
         if self.model_mode == "mm" and mod_dict["spike"]["training_mode"] == "mixed":
-            mask_map, selected_schemes = self._prepare_mixed_masking(mod_dict)
+            mask_table, scheme_idx = self._prepare_mixed_masking(mod_dict)
+            batch_idx = torch.arange(len(scheme_idx), device=scheme_idx.device)
 
         for mod, d in mod_dict.items():
 
@@ -327,19 +403,15 @@ class MultiModal(nn.Module):
                 if len(mod_dict[mod][name].size()) == 2:
                     mod_dict[mod][name] = mod_dict[mod][name].unsqueeze(-1)
                         
-            if mod_dict[mod]["eval_mask"] is None:
-                _, mask = self.masker(mod_dict[mod]["inputs"].clone(), None)
-            else:
-                mask = mod_dict[mod]["eval_mask"]
-
-            mask = mask[...,0].to(torch.int64) & mod_dict[mod]["inputs_attn_mask"]
-
             if mod_dict[mod]["training_mode"] == "mixed":
-                mask_list = []
-                for scheme in selected_schemes:
-                    tmp = mask_map[mod][scheme][0,:,0].to(torch.int64) & mod_dict[mod]["inputs_attn_mask"][0]
-                    mask_list.append(tmp.unsqueeze(0))
-                mask = torch.cat(mask_list, dim=0)
+                # Each sample takes its modality mask under its own scheme, in one gather
+                mask = mask_table[mod][scheme_idx, batch_idx] & mod_dict[mod]["inputs_attn_mask"]
+            else:
+                if mod_dict[mod]["eval_mask"] is None:
+                    _, mask = self.masker(mod_dict[mod]["inputs"], None, corrupt=False)
+                else:
+                    mask = mod_dict[mod]["eval_mask"]
+                mask = mask[...,0].to(torch.int64) & mod_dict[mod]["inputs_attn_mask"]
             
             # Mask selected modalities for encoding
             if "inputs_token_mask" in mod_dict[mod]:
@@ -352,17 +424,19 @@ class MultiModal(nn.Module):
             mod: self.encoder_embeddings[mod](d)
             for mod, d in mod_dict.items() if mod in self.encoder_embeddings
         }
-        encoder_tokens, encoder_emb, input_timestamp, encoder_mask, encoder_mod_mask = \
+        encoder_tokens, encoder_emb, input_timestamp, encoder_mask, encoder_mod_slices = \
         self.forward_mask_encoder(encoder_mod_dict)
 
         x = encoder_tokens + encoder_emb
-        x = self.forward_encoder(x, input_timestamp=input_timestamp)
+        if self.drop_masked:
+            dropped_mods = [mod for mod in encoder_mod_slices if mod_dict[mod].get("fully_masked", False)]
+            x = self.forward_drop_encoder(x, encoder_emb, input_timestamp, encoder_mod_slices, dropped_mods)
+        else:
+            x = self.forward_encoder(x, input_timestamp=input_timestamp)
 
         if self.model_mode == "mm":
             output_mod_dict = {
-                mod: self.encoder_embeddings[mod].out_proj(
-                    self.mod_to_indx[mod], d, x, encoder_mod_mask, len(self.avail_mod)
-                )
+                mod: self.encoder_embeddings[mod].out_proj(d, x, encoder_mod_slices[mod])
                 for mod, d in encoder_mod_dict.items() if mod in self.encoder_embeddings
             }
         else:
@@ -227,4 +227,18 @@ class CrossAttention(nn.Module):
         return self.out_proj(self.dropout(out)) 
 
     
-        
\ No newline at end of file
+        
+
+def mark_fully_masked(mod_dict, all_ones):
+    r"""
+    Sets ``fully_masked`` on every modality of ``mod_dict`` whose encoder inputs are masked in the
+    whole batch, i.e. whose ``inputs_token_mask`` (or ``eval_mask`` outside mixed training) is the
+    constant ``all_ones`` mask. The check compares tensors by identity, so it never reads them on the
+    device; ``MultiModal.forward_drop_encoder`` drops the marked modalities from the encoder.
+    """
+    for d in mod_dict.values():
+        if "inputs_token_mask" in d:
+            d["fully_masked"] = d["inputs_token_mask"] is all_ones
+        else:
+            d["fully_masked"] = d["training_mode"] != "mixed" and d["eval_mask"] is all_ones
+    return mod_dict
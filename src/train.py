@@ -21,6 +21,7 @@ from utils.dataset_utils import load_ibl_dataset
 from utils.config_utils import config_from_kwargs, update_config
 
 from loader.make_loader import make_loader
+from loader.base import DistributedSessionBatchSampler
 from trainer.make import make_multimodal_trainer
 
 from multi_modal.mm import MultiModal
@@ -177,6 +178,15 @@ def main(tune_config=None):
         sort_by_region=config.data.sort_by_region,
         stitching=True,
         seed=config.seed,
+        batched_fetch=config.data.batched_fetch,
+        dynamic_padding=config.data.dynamic_padding,
+        max_sessions_per_batch=config.data.max_sessions_per_batch,
+        cache_dir=config.data.cache_dir,
+        compact_dtypes=config.data.compact_dtypes,
+        verify_checksums=config.data.verify_checksums,
+        num_replicas=accelerator.num_processes,
+        rank=accelerator.process_index,
+        shard_affinity=config.data.shard_affinity,
         data_dir=f"{args.data_path}/{local_data_dir}",
         mode="train",
         eids=list(meta_data["eids"]),
@@ -196,6 +206,12 @@ def main(tune_config=None):
         sort_by_region=config.data.sort_by_region,
         stitching=True,
         seed=config.seed,
+        batched_fetch=config.data.batched_fetch,
+        dynamic_padding=config.data.dynamic_padding,
+        max_sessions_per_batch=config.data.max_sessions_per_batch,
+        cache_dir=config.data.cache_dir,
+        compact_dtypes=config.data.compact_dtypes,
+        verify_checksums=config.data.verify_checksums,
         data_dir=f"{args.data_path}/{local_data_dir}",
         mode="val",
         eids=list(meta_data["eids"]),
@@ -215,6 +231,12 @@ def main(tune_config=None):
         sort_by_region=config.data.sort_by_region,
         stitching=True,
         seed=config.seed,
+        batched_fetch=config.data.batched_fetch,
+        dynamic_padding=config.data.dynamic_padding,
+        max_sessions_per_batch=config.data.max_sessions_per_batch,
+        cache_dir=config.data.cache_dir,
+        compact_dtypes=config.data.compact_dtypes,
+        verify_checksums=config.data.verify_checksums,
         data_dir=f"{args.data_path}/{local_data_dir}",
         mode="test",
         eids=list(meta_data["eids"]),
@@ -349,9 +371,13 @@ def main(tune_config=None):
     else:
         start_epoch = 0
 
-    model, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-        model, optimizer, train_dataloader, lr_scheduler
-    )
+    if isinstance(train_dataloader.batch_sampler, DistributedSessionBatchSampler):
+        # Session batches are already split over ranks by the sampler
+        model, optimizer, lr_scheduler = accelerator.prepare(model, optimizer, lr_scheduler)
+    else:
+        model, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
+            model, optimizer, train_dataloader, lr_scheduler
+        )
 
     # -----------------------
     # TRACK MODEL & DATA SIZE
@@ -381,6 +407,7 @@ def main(tune_config=None):
         if "stitch" not in name and "static_weight" not in name
     )
     logging.info(f"Total parameters (excluding stitcher): {total_capacity}")
+    logging.info(f"Stitcher parameters per session: {(total_params - total_capacity) / num_sessions:.0f}")
 
 
     # -----
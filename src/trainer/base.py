@@ -11,6 +11,8 @@ from utils.utils import (
     plot_neurons_r2
 )
 from sklearn.metrics import balanced_accuracy_score, r2_score
+from loader.base import densify_sparse_spikes, upcast_compact_batch
+from multi_modal.mm_utils import mark_fully_masked
 
 OUTPUT_DIM = {
     "choice": 2, 
@@ -52,6 +54,7 @@ class MultiModalTrainer():
         self.num_neurons = kwargs.get("num_neurons", None)
         self.eid_list = kwargs.get("eid_list", None)
         self.multi_gpu = kwargs.get("multi_gpu", None)
+        self.pad_value = kwargs.get("pad_value", -1.)
 
         self.model_class = self.config.model.model_class
         self.session_active_neurons = {}   
@@ -83,6 +86,24 @@ class MultiModalTrainer():
         self.STATIC_VARS = ["choice", "block"]
         self.DYNAMIC_VARS = ["wheel", "whisker"]
 
+        # Constant masks and modality ids reused across steps; the model only reads them
+        self._const_masks = {}
+        self._mod_idx_tensors = {}
+
+    def _get_const_masks(self, spikes):
+        # All-ones / all-zeros [B, T, 1] masks, cached per shape and device; the model only reads
+        # their time-step slice, so the neuron dimension is not materialized
+        key = (tuple(spikes.shape[:2]), spikes.device)
+        if key not in self._const_masks:
+            all_ones = torch.ones((*spikes.shape[:2], 1), dtype=torch.int64, device=spikes.device)
+            self._const_masks[key] = (all_ones, torch.zeros_like(all_ones))
+        return self._const_masks[key]
+
+    def _get_mod_idx(self, mod):
+        if mod not in self._mod_idx_tensors:
+            self._mod_idx_tensors[mod] = torch.tensor(self.mod_to_indx[mod], device=self.accelerator.device)
+        return self._mod_idx_tensors[mod]
+
     def _prepare_multimodal_mask(self, mod_dict, training_mode, all_ones, all_zeros):
         
         if training_mode == "encoding":
@@ -119,35 +140,35 @@ class MultiModalTrainer():
         is_multimodal = not is_unimodal
         
         batch = move_batch_to_device(batch, self.accelerator.device)
+        batch = densify_sparse_spikes(batch, self.pad_value)
+        batch = upcast_compact_batch(batch, self.pad_value)
 
-        all_ones = torch.ones_like(
-            batch["spikes_data"]).to(self.accelerator.device, torch.int64
-        )
-        all_zeros = all_ones * 0.
+        all_ones, all_zeros = self._get_const_masks(batch["spikes_data"])
         
         mod_dict = {}
 
         avail_mod = self.mod_to_indx.keys()
         
         for mod in avail_mod:
-            mod_idx = self.mod_to_indx[mod]
             mod_dict[mod] = {}
-            mod_dict[mod]["inputs_modality"] = torch.tensor(mod_idx).to(self.accelerator.device)
-            mod_dict[mod]["targets_modality"] = torch.tensor(mod_idx).to(self.accelerator.device)
+            mod_dict[mod]["inputs_modality"] = self._get_mod_idx(mod)
+            mod_dict[mod]["targets_modality"] = self._get_mod_idx(mod)
             mod_dict[mod]["inputs_attn_mask"] = batch["time_attn_mask"]
             mod_dict[mod]["inputs_timestamp"] = batch["spikes_timestamps"]
             mod_dict[mod]["targets_timestamp"] = batch["spikes_timestamps"]
             # Each batch contains samples from different sessions
             mod_dict[mod]["eid"] = batch["eid"]
+            mod_dict[mod]["session_idx"] = batch["session_idx"]
             mod_dict[mod]["num_neuron"] = batch["spikes_data"].shape[-1]
             mod_dict[mod]["training_mode"] = training_mode
             
+            # Inputs and targets share the batch tensors: the masker no longer corrupts them in place
             if mod == "spike":
-                mod_dict[mod]["inputs"] = batch["spikes_data"].clone()
-                mod_dict[mod]["targets"] = batch["spikes_data"].clone()
+                mod_dict[mod]["inputs"] = batch["spikes_data"]
+                mod_dict[mod]["targets"] = batch["spikes_data"]
             elif mod in self.avail_beh:
-                mod_dict[mod]["inputs"] = batch[mod].clone()
-                mod_dict[mod]["targets"] = batch[mod].clone()
+                mod_dict[mod]["inputs"] = batch[mod]
+                mod_dict[mod]["targets"] = batch[mod]
             else:
                raise Exception(f"modality {mod} not implemented.")
             
@@ -162,6 +183,7 @@ class MultiModalTrainer():
             for mod in self.mod_to_indx.keys():
                 mod_dict[mod]["inputs_token_mask"] = all_zeros if mod == enc_task_var else all_ones
 
+        mark_fully_masked(mod_dict, all_ones)
         return self.model(mod_dict)
 
     def _plot_log_epoch(self, epoch, eval_epoch_results, n_viz=5):
@@ -277,6 +299,8 @@ class MultiModalTrainer():
         mod_loss_dict = {f"train_{mod}_loss": 0. for mod in self.modal_filter["output"]}
 
         set_seed(epoch)
+        if hasattr(self.train_dataloader.batch_sampler, "set_epoch"):
+            self.train_dataloader.batch_sampler.set_epoch(epoch)
         
         self.model.train()
         for batch in tqdm(self.train_dataloader):
@@ -34,6 +34,7 @@ from utils.utils import (
 from utils.config_utils import config_from_kwargs, update_config
 
 from multi_modal.mm import MultiModal
+from multi_modal.mm_utils import mark_fully_masked
 from multi_modal.encoder_embeddings import EncoderEmbedding
 
 NAME2MODEL = {"MultiModal": MultiModal}
@@ -337,6 +338,7 @@ def co_smoothing_eval(
                         for mod in model.mod_to_indx:
                             mod_dict[mod]["inputs_token_mask"] = all_zeros if mod == kwargs["enc_task_var"] else all_ones
                     
+                mark_fully_masked(mod_dict, all_ones)
                 outputs = model(mod_dict)
                     
             gt = outputs.mod_targets["spike"][...,:N]
@@ -444,6 +446,7 @@ def co_smoothing_eval(
                         mod_dict[mod]["eval_mask"] = \
                         all_ones if mod in model.avail_beh else all_zeros
                     
+                mark_fully_masked(mod_dict, all_ones)
                 outputs = model(mod_dict)
                                 
             gt, preds = [], []
@@ -0,0 +1,53 @@
+import os
+import numpy as np
+import torch
+
+""" Session registry. Every session (eid) has a fixed integer id given by its position in
+``data/train_eids.txt`` followed by ``data/test_eids.txt``; the loader emits these ids as
+``session_idx`` so the model can index per-session parameters with tensors instead of strings.
+"""
+
+PROJ_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_session_registry():
+    registry = []
+    for split in ["train", "test"]:
+        with open(f"{PROJ_DIR}/data/{split}_eids.txt") as file:
+            registry += [line.rstrip() for line in file]
+    return registry
+
+
+SESSION_REGISTRY = load_session_registry()
+SESSION_TO_IDX = {eid: idx for idx, eid in enumerate(SESSION_REGISTRY)}
+
+
+def get_session_idx(eids):
+    # Registry ids of `eids`; unregistered sessions raise a KeyError
+    eids = [str(eid) for eid in np.atleast_1d(eids)]
+    missing = sorted(set(eid for eid in eids if eid not in SESSION_TO_IDX))
+    if missing:
+        raise KeyError(f"Sessions {missing} are not in the session registry.")
+    return np.array([SESSION_TO_IDX[eid] for eid in eids], dtype=np.int64)
+
+
+def get_batch_session_idx(d, device):
+    # `session_idx` of a model input dict, looked up from its eids when the loader did not provide it
+    if "session_idx" in d:
+        return d["session_idx"].to(device, torch.int64).reshape(-1)
+    return torch.from_numpy(get_session_idx(d["eid"])).to(device)
+
+
+def get_registry_lookup(eids):
+    # Maps registry ids to positions in `eids`, for gathering from per-session parameters. Sessions
+    # not in `eids` map to `len(eids)`, one past the last position, so that gathering their
+    # parameters fails with an index error instead of wrapping around to the last session
+    lookup = torch.full((len(SESSION_REGISTRY),), len(eids), dtype=torch.int64)
+    lookup[torch.from_numpy(get_session_idx(eids))] = torch.arange(len(eids))
+    return lookup
+
+
+def gather_session_params(params, lookup, session_idx):
+    # Per-sample rows of the per-session parameters `params` (a ParameterDict whose keys were passed
+    # to `get_registry_lookup`), gathered with tensor indexing only
+    return torch.stack(list(params.values()))[lookup[session_idx]]
@@ -0,0 +1,151 @@
+import numpy as np
+import pytest
+import torch
+from loader.base import BaseDataset, collate_trials, upcast_compact_batch
+from loader.shards import ShardWriter, load_npy_manifest
+from utils.session_utils import SESSION_REGISTRY
+
+T, N = 6, 5
+
+
+def write_compact_shards(root, n_neurons=(4, 2), n_trials=3):
+    # uint8 spikes and bool masks, as exported by `create_dataset.py` with `compact_dtypes`
+    rng = np.random.default_rng(0)
+    writer = ShardWriter(f"{root}/train", max_time_length=T)
+    for eid, n in zip(SESSION_REGISTRY, n_neurons):
+        for trial in range(n_trials):
+            n_time = T - trial
+            spikes_data = np.zeros((T, N), dtype=np.uint8)
+            spikes_data[:n_time, :n] = rng.integers(0, 4, size=(n_time, n))
+            writer.add({
+                "eid": eid,
+                "spikes_data": spikes_data,
+                "time_attn_mask": np.arange(T) < n_time,
+                "space_attn_mask": np.arange(N) < n,
+                "target": np.zeros((T, 2), dtype=np.float16),
+                "choice": np.float16(trial % 2),
+                "block": np.float16(1),
+                "reward": np.ones(1, dtype=np.float16),
+            })
+    writer.close()
+
+
+@pytest.mark.parametrize("batched_fetch", [False, True])
+def test_compact_shards_keep_pad_value(tmp_path, batched_fetch):
+    write_compact_shards(tmp_path)
+    spikes = {}
+    for compact_dtypes in [False, True]:
+        dataset = BaseDataset(
+            None, data_dir=str(tmp_path), mode="train", max_time_length=T, max_space_length=N,
+            batched_fetch=batched_fetch, compact_dtypes=compact_dtypes,
+        )
+        batch = collate_trials(dataset.__getitems__(list(range(len(dataset)))))
+        if compact_dtypes:
+            assert batch["spikes_data"].dtype == torch.uint8
+            batch = upcast_compact_batch(batch)
+        assert batch["spikes_data"].dtype == torch.float32
+        valid = batch["time_attn_mask"].bool()[:, :, None] & batch["space_attn_mask"].bool()[:, None, :]
+        assert torch.all(batch["spikes_data"][~valid] == -1)
+        assert torch.all(batch["spikes_data"][valid] >= 0)
+        spikes[compact_dtypes] = batch["spikes_data"]
+    torch.testing.assert_close(spikes[False], spikes[True])
+
+
+def make_ibl_dataset(n_neurons=(4, 3), n_trials=2):
+    # Rows in the layout of the aligned Hugging Face datasets, with spikes as CSR triplets
+    from datasets import Dataset
+    from scipy.sparse import csr_array
+    rng = np.random.default_rng(0)
+    columns = {key: [] for key in [
+        "eid", "spikes_sparse_data", "spikes_sparse_indices", "spikes_sparse_indptr", "spikes_sparse_shape",
+        "wheel-speed", "choice", "block", "reward", "cluster_depths", "cluster_regions",
+    ]}
+    for eid, n in zip(SESSION_REGISTRY, n_neurons):
+        for trial in range(n_trials):
+            spikes = csr_array(rng.integers(0, 3, size=(T, n)).astype(np.float64))
+            columns["eid"].append(eid)
+            columns["spikes_sparse_data"].append(spikes.data.tolist())
+            columns["spikes_sparse_indices"].append(spikes.indices.tolist())
+            columns["spikes_sparse_indptr"].append(spikes.indptr.tolist())
+            columns["spikes_sparse_shape"].append([T, n])
+            columns["wheel-speed"].append(rng.normal(size=T).tolist())
+            columns["choice"].append([[-1.0, 1.0][trial % 2]])
+            columns["block"].append([0.5])
+            columns["reward"].append([1.0])
+            # Pairs of neurons share a depth so that ties have to keep their stored order
+            columns["cluster_depths"].append((rng.permutation(n) // 2).astype(np.float64).tolist())
+            columns["cluster_regions"].append([["CA1", "VISp", "PO"][i % 3] for i in range(n)])
+    return Dataset.from_dict(columns)
+
+
+def assert_batches_equal(batch, expected):
+    assert batch.keys() == expected.keys()
+    for key, value in expected.items():
+        if torch.is_tensor(value):
+            assert batch[key].dtype == value.dtype, key
+            torch.testing.assert_close(batch[key], value, equal_nan=True, msg=key)
+        else:
+            assert batch[key] == value, key
+
+
+@pytest.mark.parametrize("load_meta", [False, True])
+@pytest.mark.parametrize("sort_by", [None, "depth", "region"])
+@pytest.mark.parametrize("dynamic_padding", [False, True])
+def test_batched_ibl_fetch_matches_per_trial_collate(load_meta, sort_by, dynamic_padding):
+    hf_dataset = make_ibl_dataset()
+    kwargs = dict(
+        target=["wheel-speed"], max_time_length=T, max_space_length=N, load_meta=load_meta,
+        sort_by_depth=sort_by == "depth", sort_by_region=sort_by == "region", dynamic_padding=dynamic_padding,
+    )
+    indices = [3, 0, 2]
+    dataset = BaseDataset(hf_dataset, **kwargs)
+    expected = collate_trials([dataset[idx] for idx in indices], dynamic_padding=dynamic_padding)
+    dataset = BaseDataset(hf_dataset, batched_fetch=True, **kwargs)
+    batch = collate_trials(dataset.__getitems__(indices), dynamic_padding=dynamic_padding)
+    assert_batches_equal(batch, expected)
+
+
+def test_h5_trials_have_no_session_idx():
+    # (spikes, rates, ...) tuples of the non-IBL h5 datasets carry no session
+    spikes = np.random.default_rng(0).poisson(1., size=(3, T - 2, N)).astype(np.float32)
+    dataset = BaseDataset((spikes, spikes, None, None), dataset_name="lorenz", max_time_length=T)
+    trial = dataset[1]
+    assert "session_idx" not in trial
+    assert trial["spikes_data"].shape == (T, N)
+    np.testing.assert_array_equal(trial["attention_mask"], np.arange(T) < T - 2)
+
+
+def test_shards_do_not_store_session_idx(tmp_path):
+    # Re-export the trials as `create_dataset.py` does, from the dicts returned by BaseDataset
+    write_compact_shards(tmp_path)
+    dataset = BaseDataset(None, data_dir=str(tmp_path), mode="train", max_time_length=T, max_space_length=N)
+    assert "session_idx" in dataset[0]
+    writer = ShardWriter(f"{tmp_path}/val", max_time_length=T)
+    for idx in range(len(dataset)):
+        writer.add(dataset[idx])
+    assert "session_idx" not in writer.close()["fields"]
+    dataset = BaseDataset(None, data_dir=str(tmp_path), mode="val", max_time_length=T, max_space_length=N)
+    assert dataset[0]["session_idx"] == 0
+
+
+def test_cached_npy_manifest_is_checked_against_the_split(tmp_path):
+    # Legacy splits hold one pickled `{eid}_{count}.npy` dict per trial
+    split = tmp_path / "train"
+    split.mkdir()
+    eids = sorted(SESSION_REGISTRY)[:2]
+    for eid in eids:
+        for count in range(2):
+            np.save(split / f"{eid}_{count}.npy", {"eid": eid}, allow_pickle=True)
+    manifest = load_npy_manifest(str(tmp_path), "train")
+    assert (split / "npy_manifest.json").exists()
+    assert load_npy_manifest(str(tmp_path), "train") == manifest
+
+    (split / f"{eids[0]}_1.npy").unlink()
+    np.save(split / f"{eids[1]}_2.npy", {"eid": eids[1]}, allow_pickle=True)
+    with pytest.raises(ValueError, match="missing") as error:
+        load_npy_manifest(str(tmp_path), "train")
+    assert "not indexed" in str(error.value)
+
+    (split / "npy_manifest.json").unlink()
+    sessions = load_npy_manifest(str(tmp_path), "train")["sessions"]
+    assert [session["n_trials"] for session in sessions] == [1, 3]
@@ -0,0 +1,43 @@
+import random
+import torch
+from models.masker import Masker
+from utils.config_utils import DictConfig
+
+
+def make_masker(**kwargs):
+    config = {
+        "force_active": True, "mode": "temporal", "ratio": 0.3, "zero_ratio": 1.0, "random_ratio": 1.0,
+        "expand_prob": 0.5, "max_timespan": 3, "channels": None, "timesteps": None,
+        "mask_regions": ["all"], "target_regions": ["all"], "n_mask_regions": 1, "causal_zero": True,
+    }
+    config.update(kwargs)
+    return Masker(DictConfig(config))
+
+
+def causal_fill_loop(mask):
+    # Per-trial fill the masker used before `Masker.causal_fill`
+    mask = mask.clone().int()
+    idx = torch.argmax(mask, dim=1)
+    for j in range(mask.shape[0]):
+        mask[j, idx[j]:] = 1
+    return mask.bool()
+
+
+def test_causal_fill_matches_loop():
+    torch.manual_seed(0)
+    mask = torch.rand(64, 20) < 0.05
+    mask[:3] = False
+    mask[3, -1] = True
+    assert (~mask.any(1)).sum() >= 3
+    assert torch.equal(Masker.causal_fill(mask), causal_fill_loop(mask))
+
+
+def test_masks_follow_torch_seed_only():
+    masker = make_masker()
+    spikes = torch.rand(8, 20, 5)
+    masks = []
+    for python_seed in [0, 1]:
+        torch.manual_seed(0)
+        random.seed(python_seed)
+        masks.append(masker(spikes, None, corrupt=False)[1])
+    assert torch.equal(masks[0], masks[1])
@@ -0,0 +1,22 @@
+import pytest
+import torch
+from torch import nn
+from utils.session_utils import SESSION_REGISTRY, get_session_idx, get_registry_lookup, gather_session_params
+
+
+def test_unregistered_session_raises():
+    with pytest.raises(KeyError):
+        get_session_idx([SESSION_REGISTRY[0], "not-a-session"])
+    with pytest.raises(KeyError):
+        get_registry_lookup(["not-a-session"])
+
+
+def test_gather_session_params_rejects_sessions_without_params():
+    eids = SESSION_REGISTRY[:2]
+    params = nn.ParameterDict({eid: nn.Parameter(torch.full((3,), float(i))) for i, eid in enumerate(eids)})
+    lookup = get_registry_lookup(eids)
+    session_idx = torch.from_numpy(get_session_idx([eids[1], eids[0]]))
+    assert gather_session_params(params, lookup, session_idx)[:, 0].tolist() == [1., 0.]
+    # Registered, but without parameters: must not fall back to the last session
+    with pytest.raises(IndexError):
+        gather_session_params(params, lookup, torch.from_numpy(get_session_idx(SESSION_REGISTRY[2])))
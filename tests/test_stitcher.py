@@ -0,0 +1,13 @@
+import pytest
+import torch
+from models.stitcher import StackedStitchEncoder, StackedStitchDecoder
+from utils.session_utils import SESSION_REGISTRY, get_session_idx
+
+
+@pytest.mark.parametrize("stitcher", [StackedStitchEncoder, StackedStitchDecoder])
+def test_stacked_stitcher_rejects_sessions_without_weights(stitcher):
+    model = stitcher({eid: 4 for eid in SESSION_REGISTRY[:2]}, n_channels=8)
+    pos = model.positions(None, torch.from_numpy(get_session_idx(SESSION_REGISTRY[:2][::-1])), "cpu")
+    assert pos.tolist() == [1, 0]
+    with pytest.raises(KeyError):
+        model.positions(None, torch.from_numpy(get_session_idx(SESSION_REGISTRY[2])), "cpu")